@@ -0,0 +1,83 @@
+"""
+Spending statistics computed with NumPy.
+
+The landing and stats pages are built from DailyAnalytics, which only needs
+a plan's DailySpending rollups, one row per day, and so costs the same
+however many purchases the days hold.
+"""
+
+import datetime
+
+import numpy as np
+
+
+class DailyAnalytics:
+    """Statistics from a plan's DailySpending rows, along with the few purchases
+    they can't be derived from. The rows have to cover every window asked for."""
+
+    def __init__(self, days, current_balance, last_deposit=None, first_purchases=(), today=None):
+        self.today = today if today is not None else datetime.date.today()
+        self.current_balance = current_balance
+        self.last_deposit = last_deposit
+        self.first_purchases = list(first_purchases)
+        count = len(days)
+        self._set_daily(np.fromiter((day.date.toordinal() for day in days), dtype=np.int64, count=count),
+            np.fromiter((day.total for day in days), dtype=np.float64, count=count))
+
+    def get_current_balance(self):
+        """Return the balance after the newest purchase"""
+        return float(self.current_balance)
+
+    def get_starting_balance(self):
+        """Return the balance after the newest deposit (or rollover move) of the semester"""
+        return float(self.last_deposit.new_balance) if self.last_deposit is not None else 0
+
+    def get_deposit(self):
+        """Return the oldest deposit, the one the plan started with"""
+        return -1 * float(self.first_purchases[0].amount)
+
+    def get_recommended_balance(self, end_date: datetime.datetime, current_date: datetime.datetime):
+        """Return how much of the deposit should have been spent by now to last until end_date,
+        counting from the first purchase after the deposit. Nothing while there is none."""
+        if len(self.first_purchases) < 2:
+            return 0.0
+        first_date = self.first_purchases[1].dt
+        if (end_date - first_date).days <= 0:
+            return self.get_deposit()
+        return (self.get_deposit() / (end_date - first_date).days) * (current_date - first_date).days
+
+    def _set_daily(self, ordinals, totals):
+        """Sums totals into one slot per day given by their date ordinals, with prefix sums for windows"""
+        today_ordinal = self.today.toordinal()
+        self.start = min(int(ordinals.min()), today_ordinal) if len(ordinals) else today_ordinal
+        in_range = ordinals <= today_ordinal
+        self.daily = np.bincount(ordinals[in_range] - self.start,
+            weights=totals[in_range], minlength=today_ordinal - self.start + 1)
+        self.prefix = np.concatenate(([0.0], np.cumsum(self.daily)))
+
+    def get_spending(self, days=7, backwards_offset=0):
+        """Return cost over the given number of days, ending
+        backwards_offset days before today."""
+        last = len(self.prefix) - 1
+        end = min(max(last - backwards_offset, 0), last)
+        begin = min(max(last - backwards_offset - days, 0), last)
+        return round(float(self.prefix[end] - self.prefix[begin]), 2)
+
+    def get_daily_totals(self, days, until=None):
+        """Return {date: total} for the given number of days back from today, newest first.
+        Days after until are left out."""
+        today_ordinal = self.today.toordinal()
+        ordinals = np.arange(today_ordinal, today_ordinal - days, -1)
+        indexes = ordinals - self.start
+        totals = np.where(indexes >= 0, self.daily[np.clip(indexes, 0, None)], 0.0)
+        if until is not None:
+            keep = ordinals <= until.toordinal()
+            ordinals, totals = ordinals[keep], totals[keep]
+        return {datetime.date.fromordinal(int(ordinal)): round(float(total), 2)
+            for ordinal, total in zip(ordinals, totals)}
+
+    def get_daily_budget(self, end_date: datetime.datetime, current_date: datetime.datetime):
+        """Return how much can be spent per day until end_date,
+        based off the balance in the account yesterday"""
+        budget = round((self.get_current_balance() - self.get_spending(1)) / (end_date - current_date).days, 2)
+        return budget if budget != 0 else 1
@@ -0,0 +1,172 @@
+"""
+JSON API the Purchases, Stats and Importing pages load their data from.
+
+Responses only hold what the page is about to show: purchases come in
+keyset paginated pages and the chart gets one total per day. Every response
+carries an ETag, so unchanged data is answered with a 304, and large
+responses are gzipped for clients that accept it.
+"""
+
+import base64
+import datetime
+import gzip
+
+from flask import Blueprint, jsonify, request
+
+from importer import importer, EMPTY, FAILED, IMPORTED, RUNNING
+from lib import check_session_value, get_session_value
+import database
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# responses smaller than this are sent as they are
+min_gzip_size = 1024
+max_page_size = 500
+
+
+class ApiError(Exception):
+    """Turned into a JSON error response with the given status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def handle_api_error(ex):
+    return jsonify(error=ex.message), ex.status
+
+@api.after_request
+def compress(response):
+    """Gzips responses for clients that accept it"""
+    response.vary.add('Accept-Encoding')
+    if (response.status_code == 200 and not response.direct_passthrough
+            and 'gzip' in request.headers.get('Accept-Encoding', '')
+            and response.content_length is not None and response.content_length >= min_gzip_size):
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def conditional(payload):
+    """JSON response for payload that is answered with a 304 if the client has it already"""
+    response = jsonify(payload)
+    # weak, the same data is sent both gzipped and not
+    response.add_etag(weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def get_user_plan():
+    """The signed in user and the plan asked for, their default plan if none was"""
+    if not check_session_value('id'):
+        raise ApiError("Not signed in", 401)
+    uid = get_session_value('id')
+    plan_id = request.args.get('plan', type=int)
+    if plan_id is None:
+        session_data = database.get_session_data(uid)
+        if session_data is None:
+            raise ApiError("Not signed in", 401)
+        plan_id = session_data.default_plan
+    return uid, plan_id
+
+def get_date_arg(name):
+    """Parses a YYYY-MM-DD query argument into the datetime it starts at"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.datetime.combine(datetime.date.fromisoformat(value), datetime.time())
+    except ValueError:
+        raise ApiError(f"'{name}' has to be a YYYY-MM-DD date")
+
+def get_range_args():
+    """since and until, until being inclusive"""
+    since, until = get_date_arg('since'), get_date_arg('until')
+    if until is not None:
+        until += datetime.timedelta(days=1)
+    return since, until
+
+def encode_cursor(purchase):
+    return base64.urlsafe_b64encode(f"{purchase.dt.isoformat()}|{purchase.pid}".encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        dt, pid = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.datetime.fromisoformat(dt), pid
+    except ValueError:
+        raise ApiError("Invalid cursor")
+
+@api.route('/purchases')
+def purchases():
+    """A page of the user's purchases, newest first.
+    args: plan, since, until (YYYY-MM-DD), limit, cursor (next_cursor of the previous page)"""
+    uid, plan_id = get_user_plan()
+    since, until = get_range_args()
+    limit = max(1, min(request.args.get('limit', 100, type=int), max_page_size))
+    cursor = request.args.get('cursor')
+    before = decode_cursor(cursor) if cursor else None
+
+    # one extra row tells whether there is another page
+    page = database.get_purchase_page(uid, plan_id, since, until, before, limit + 1)
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    return conditional({
+        'plan': plan_id,
+        'purchases': [{
+            'dt': purchase.dt.isoformat(),
+            'date': purchase.dt.strftime("%m/%d/%Y"),
+            'time': purchase.dt.strftime("%-I:%M%p"),
+            'location': purchase.display_location,
+            'category': purchase.category,
+            'amount': purchase.amount,
+            'new_balance': purchase.new_balance
+        } for purchase in page],
+        'next_cursor': encode_cursor(page[-1]) if has_more else None
+    })
+
+@api.route('/daily')
+def daily():
+    """The user's spending per day, for days with purchases, newest first.
+    args: plan, since, until (YYYY-MM-DD)"""
+    uid, plan_id = get_user_plan()
+    since, until = get_range_args()
+
+    return conditional({
+        'plan': plan_id,
+        'days': [{'date': date.isoformat(), 'total': total, 'count': count}
+            for date, total, count in database.get_daily_totals(uid, plan_id, since, until)]
+    })
+
+@api.route('/import')
+def import_status():
+    """Progress of the signed in user's first import, per plan. ready turns true once
+    the default plan is imported, or once every import finished and any plan was imported."""
+    if not check_session_value('id'):
+        raise ApiError("Not signed in", 401)
+    uid = get_session_value('id')
+    session_data = database.get_session_data(uid)
+    if session_data is None:
+        raise ApiError("Not signed in", 401)
+
+    states = {state.plan_id: state for state in database.get_sync_states(uid)}
+    imported = {plan_id for plan_id, state in states.items() if state.imported}
+    # imports running in this process are reported as they are, the others from their SyncState,
+    # running until one shows up
+    statuses = importer.get_statuses(uid)
+    for plan_id, state in states.items():
+        if not state.imported and statuses.get(plan_id) != RUNNING:
+            statuses[plan_id] = FAILED if state.import_failed else EMPTY
+    plans = [{
+        'plan': plan.plan_id,
+        'name': plan.plan_name,
+        'status': IMPORTED if plan.plan_id in imported else statuses.get(plan.plan_id, RUNNING)
+    } for plan in database.get_meal_plans(uid)]
+    finished = all(plan['status'] != RUNNING for plan in plans)
+
+    return conditional({
+        'plans': plans,
+        'finished': finished,
+        'ready': session_data.default_plan in imported or (finished and bool(imported))
+    })
@@ -7,13 +7,15 @@ in a more efficient and well-tailored manner.
 # TODO add notification rules for each channel
 
 import datetime
+import hashlib
+import math
 import os
 import time
-from threading import Thread
 
 from dotenv import load_dotenv
 
-from flask import Flask, redirect, render_template, request
+from flask import Flask, redirect, render_template, request, url_for, g
+from werkzeug.http import is_resource_modified
 
 from lib import (
     log_to_console,
@@ -21,16 +23,17 @@ from lib import (
     check_session_value,
     get_session_value,
     get_session,
+    get_request_context,
     set_session_value,
     get_datetimes,
-    get_first_purchase_date,
-    get_spending_over_time,
     first_date,
-    get_spending_per_day,
 )
-from conn import get_formatted_spending, get_user_plans, get_account_info
-from regen import extend_skey
+from analytics import DailyAnalytics
+from api import api
+from conn import get_user_plans, get_account_info, get_account_page
+from importer import importer
 import database
+import metrics
 
 # load environment variables
 load_dotenv()
@@ -38,18 +41,112 @@ load_dotenv()
 # intialize Flask app
 app = Flask(__name__)
 app.secret_key = os.urandom(16)
+# before every other hook, so requests answered early are timed too
+metrics.instrument_app(app)
+metrics.instrument_database(database.engine, database.get_pool_stats)
+app.register_blueprint(api)
 
 # set local time zone
 os.environ['TZ'] = "America/New_York"
 time.tzset()
 
-# start skey regen thread
-print("Starting background thread")
-Thread(
-    target=extend_skey,
-    args=(float(os.environ['UPDATE_RATE']), int(os.environ['NUM_THREADS'])),
-    daemon=True,
-    name='Background').start()
+# the background sync runs in its own process, see worker.py
+
+# views that read the signed in user's data from the request context
+context_views = {'landing', 'purchases', 'settings', 'stats', 'importing'}
+
+# views answered with a 304 while the signed in user's data is unchanged
+cached_views = {'landing', 'purchases', 'stats'}
+
+# a year, static URLs change with their content
+static_max_age = 365 * 24 * 60 * 60
+
+def get_static_versions():
+    """Fingerprints of the content of every static file, by their path under the static folder"""
+    versions = {}
+    for root, _, files in os.walk(app.static_folder):
+        for filename in files:
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as file:
+                version = hashlib.md5(file.read()).hexdigest()[:12]
+            versions[os.path.relpath(path, app.static_folder).replace(os.sep, '/')] = version
+    return versions
+
+# computed once, static files only change with a deploy
+static_versions = get_static_versions()
+
+def get_deploy_version():
+    """Fingerprint of the templates and static files, so a deploy changes every page's ETag"""
+    digest = hashlib.md5()
+    for folder in (app.template_folder, app.static_folder):
+        folder = os.path.join(app.root_path, folder)
+        for root, _, files in sorted(os.walk(folder)):
+            for filename in sorted(files):
+                with open(os.path.join(root, filename), 'rb') as file:
+                    digest.update(file.read())
+    return digest.hexdigest()
+
+deploy_version = get_deploy_version()
+
+def get_page_version(uid):
+    """Returns the ETag and Last-Modified of the requested page for the signed in user,
+    (None, None) if the user doesn't exist"""
+    version = database.get_data_version(uid)
+    if version is None:
+        return None, None
+    default_plan, plan_count, synced_at = version
+    # the pages count days back from today, so they change at midnight too
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    key = f"{deploy_version}|{request.full_path}|{uid}|{get_session_value('theme')}|{default_plan}|{plan_count}|{synced_at}|{today}"
+    last_modified = max(synced_at, today) if synced_at is not None else today
+    return hashlib.md5(key.encode()).hexdigest(), last_modified.astimezone(datetime.timezone.utc)
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    """Adds the content fingerprint to static URLs, so they can be cached for good"""
+    if endpoint == 'static' and 'filename' in values:
+        version = static_versions.get(values['filename'])
+        if version is not None:
+            values['v'] = version
+
+@app.before_request
+def load_request_context():
+    """Loads the signed in user's data once, for every view to share.
+    Pages the browser already has the current version of are answered
+    with a 304 before anything else is loaded."""
+    g.context = None
+    g.page_version = (None, None)
+    if request.endpoint in cached_views and request.method == 'GET' and check_session_value('id'):
+        g.page_version = get_page_version(get_session_value('id'))
+        etag, last_modified = g.page_version
+        if etag is not None and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = app.response_class(status=304)
+            return set_page_version(response)
+    if request.endpoint in context_views and check_session_value('id'):
+        g.context = database.load_request_context(get_session_value('id'))
+
+def set_page_version(response):
+    """Lets the browser revalidate the page with the ETag and Last-Modified it was served with"""
+    etag, last_modified = g.page_version
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.after_request
+def set_cache_headers(response):
+    """Caching headers for the user's pages and the static files"""
+    if request.endpoint == 'static':
+        filename = (request.view_args or {}).get('filename', '')
+        if response.status_code == 200 and request.args.get('v') and request.args.get('v') == static_versions.get(filename):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = static_max_age
+            response.cache_control.immutable = True
+    elif request.endpoint in cached_views and response.status_code == 200 and g.get('page_version', (None,))[0]:
+        set_page_version(response)
+    return response
 
 
 @app.route('/')
@@ -60,20 +157,20 @@ def landing():
     if not check_session_value('theme'):
         set_session_value('theme', 'dark')
 
-    if database.user_exists(get_session_value('id')):
-        spending = database.get_purchases(
-            get_session_value('id'),
-            database.get_session_data(get_session_value('id')).default_plan
-        )
-        if spending == []:
-            get_session().pop('id')
-            return redirect('/')
-        elif spending is None:
-            for plan in database.get_meal_plans(get_session_value('id')):
-                spending = database.get_purchases(get_session_value('id'), plan.plan_id)
-                if spending is not None:
-                    database.change_default_plan(get_session_value('id'), plan.plan_id)
+    context = get_request_context()
+    if context is not None:
+        uid = get_session_value('id')
+        sync_state = context.sync_state
+        if sync_state is None:
+            for plan in context.meal_plans:
+                sync_state = database.get_sync_state(uid, plan.plan_id)
+                if sync_state is not None and sync_state.imported:
+                    database.change_default_plan(uid, plan.plan_id)
+                    context.session_data.default_plan = plan.plan_id
                     break
+            else:
+                # nothing has been imported yet
+                return redirect('/importing')
     else:
         log_to_console("id was invalid")
         if check_session_value('id'):
@@ -82,37 +179,23 @@ def landing():
             redir=f"https://tigerspend.rit.edu/login.php?wason={request.url_root}auth")
 
     firstdate, currentdate, lastdate = get_datetimes()
+    plan_id = context.session_data.default_plan
 
-    # get the number of days until the end of the semester
-    delta = lastdate - currentdate
-
-    starting_balance = 0
-    for item in spending:
-        if item.dt > firstdate:
-            if item.location == 'Deposit':
-                starting_balance = item.new_balance
-                break
-            elif 'Moves' in item.location and item.new_balance != 0:
-                starting_balance = item.new_balance
-                break
-    current_balance = float(spending[0].new_balance)
-
-    # get daily budget based off balance in account yesterday
-    daily_budget = round(
-        ((current_balance - get_spending_over_time(spending, 1)) / delta.days), 2)
-
-    if daily_budget == 0:
-        daily_budget = 1
+    # the days of the semester, and at least the month the windows below look back over
+    since = min(firstdate.date(), currentdate.date() - datetime.timedelta(days=31))
+    analytics = DailyAnalytics(database.get_daily_spending(uid, plan_id, since), sync_state.last_balance,
+        last_deposit=database.get_last_deposit(uid, plan_id, firstdate))
+    starting_balance = analytics.get_starting_balance()
 
     # packaging up data to send to template
-    data = [current_balance, daily_budget,
-        get_spending_over_time(spending, 1),
-        get_spending_over_time(spending, 7, 1),
-        get_spending_over_time(spending, 30, 1)]
+    data = [analytics.get_current_balance(),
+        analytics.get_daily_budget(lastdate, currentdate),
+        analytics.get_spending(1),
+        analytics.get_spending(7, 1),
+        analytics.get_spending(30, 1)]
 
     view = render_template("index.html", session=get_session(), data=data,
-        records=spending, plan_name=get_meal_plan_name(database.get_session_data(get_session_value('id')).default_plan),
-        plans=database.get_meal_plans(get_session_value('id')), starting_balance=starting_balance)
+        plan_name=get_meal_plan_name(plan_id), plans=context.meal_plans, starting_balance=starting_balance)
 
     return view
 
@@ -125,24 +208,44 @@ def purchases():
     if not check_session_value('theme'):
         set_session_value('theme', 'dark')
     
-    if database.user_exists(get_session_value('id')):
-        spending = database.get_purchases(get_session_value('id'), database.get_session_data(get_session_value('id')).default_plan)
-        if spending == []:
-            get_session().pop('id')
-            return redirect('/')
-    else:
+    context = get_request_context()
+    if context is None:
         log_to_console("id was invalid")
         if check_session_value('id'):
             get_session().pop('id')
         return redirect('/')
 
-    _, currentdate, _ = get_datetimes()
-    delta = currentdate - first_date
+    # the purchases themselves are loaded page by page from /api/purchases
+    return render_template("purchases.html", session=get_session(),
+            plan=context.session_data.default_plan, plans=context.meal_plans)
 
-    spending_per_day, _, _ = get_spending_per_day(spending, delta.days)
-    
-    return render_template("purchases.html", session=get_session(), spending=spending_per_day,
-            plans=database.get_meal_plans(get_session_value('id')))
+@app.route('/importing')
+def importing():
+    """Shown while a new user's plans are imported, until the data of one of them can be shown"""
+
+    # give theme value if not already given
+    if not check_session_value('theme'):
+        set_session_value('theme', 'dark')
+
+    context = get_request_context()
+    if context is None:
+        return redirect('/')
+
+    next_url = request.args.get('next', '/')
+    if not next_url.startswith('/') or next_url.startswith('//'):
+        next_url = '/'
+    return render_template("importing.html", session=get_session(),
+        plans=context.meal_plans, next_url=next_url)
+
+def parse_balance_threshold(value):
+    """Returns a balance threshold sent by the settings page, None if it isn't a positive amount or 0"""
+    try:
+        threshold = round(float(value), 2)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(threshold) or threshold < 0:
+        return None
+    return threshold
 
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
@@ -176,27 +279,31 @@ def settings():
                 settings.phone_number = post_data['phone-number']
             else:
                 settings.phone_number = old_settings.phone_number
+            if 'balance-threshold' in post_data:
+                settings.balance_threshold = parse_balance_threshold(post_data['balance-threshold'])
+                if settings.balance_threshold is None:
+                    return {'error': "Balance alert is invalid."}, 400
+            else:
+                settings.balance_threshold = old_settings.balance_threshold
 
             database.update_user_settings(settings)
+            if g.context is not None and post_data['id'] == g.context.user.uid:
+                g.context.settings = database.get_user_settings(post_data['id'])
 
     # give theme value if not already given
     if not check_session_value('theme'):
         set_session_value('theme', 'dark')
 
-    if database.user_exists(get_session_value('id')):
-        spending = database.get_purchases(get_session_value('id'), database.get_session_data(get_session_value('id')).default_plan)
-        if spending == []:
-            get_session().pop('id')
-            return redirect('/')
-    else:
+    context = get_request_context()
+    if context is None:
         log_to_console("id was invalid")
         if check_session_value('id'):
             get_session().pop('id')
         return redirect('/')
 
     return render_template("settings.html", session=get_session(),
-        plans=database.get_meal_plans(get_session_value('id')),
-        settings=database.get_user_settings(get_session_value('id')).toJson())
+        plans=context.meal_plans,
+        settings=context.settings.toJson())
 
 @app.route('/stats')
 def stats():
@@ -206,10 +313,10 @@ def stats():
     if not check_session_value('theme'):
         set_session_value('theme', 'dark')
 
-    if database.user_exists(get_session_value('id')):
-        spending = database.get_purchases(get_session_value('id'), database.get_session_data(get_session_value('id')).default_plan)
-        if spending == []:
-            get_session().pop('id')
+    context = get_request_context()
+    if context is not None:
+        if context.sync_state is None:
+            # the landing page switches to a plan with purchases
             return redirect('/')
     else:
         log_to_console("id was invalid")
@@ -218,38 +325,17 @@ def stats():
         return render_template("index.html", session=get_session(),
             redir=f"https://tigerspend.rit.edu/login.php?wason={request.url_root}auth")
 
-    _, currentdate, enddate = get_datetimes()
-    firstdate = get_first_purchase_date(spending)
-    sincefirst = currentdate - firstdate
-    totaldays = enddate - firstdate
-
-    balance = float(spending[0].new_balance)
-    deposit = -1 * float(spending[-1].amount)
-    recommended_balance = (deposit / totaldays.days) * sincefirst.days
-
-    money_spent_per_day = {}
-
-    delta = currentdate - first_date
-    for i in range(delta.days + 1):
-        date = datetime.datetime.strftime(currentdate - datetime.timedelta(days=i), "%-m/%-d")
-        money_spent_per_day[date] = get_spending_over_time(spending, 1, i)
-
-    spending_per_day, _, _ = get_spending_per_day(spending, delta.days)
-
-    cost_per_day = {}
-    for key, value in spending_per_day.items():
-        if key > get_datetimes()[0].date():
-            continue
-        if key not in cost_per_day:
-            cost_per_day[key] = 0.0
-        for val in value:
-            cost_per_day[key] -= float(val.amount)
+    startdate, currentdate, enddate = get_datetimes()
+    uid, plan_id = get_session_value('id'), context.session_data.default_plan
+    analytics = DailyAnalytics([], context.sync_state.last_balance,
+        first_purchases=database.get_purchases(uid, plan_id, limit=2, order='asc') or [])
 
+    # the chart loads its days from /api/daily
     return render_template("stats.html", session=get_session(),
-            balance=balance, deposit=deposit,
-            recommended_balance = recommended_balance,
-            plans=database.get_meal_plans(get_session_value('id')),
-            cost_per_day=cost_per_day)
+            balance=analytics.get_current_balance(), deposit=analytics.get_deposit(),
+            recommended_balance = analytics.get_recommended_balance(enddate, currentdate),
+            plan=plan_id, plans=context.meal_plans,
+            chart_since=first_date.date(), chart_until=startdate.date())
 
 ##@app.route('/vending', methods=['GET', 'POST'])
 ##def vending():
@@ -310,15 +396,18 @@ def auth():
 
     if 'skey' in request.args.keys():
         skey = str(request.args.get('skey'))
-        account_info = get_account_info(skey)
+        # the account page has both the account info and the plans, so it is only fetched once
+        page = None if check_session_value('id') else get_account_page(skey)
+        account_info = get_account_info(skey) if page is None else page.account_info
         set_session_value('id', account_info[0])
 
         if database.user_exists(account_info[0]):
-            database.log_user_auth(account_info[0])
-            database.update_skey(account_info[0], skey)
+            with database.use_session() as session:
+                database.log_user_auth(account_info[0], session)
+                database.update_skey(account_info[0], skey, session)
 
         else:
-            plans = get_user_plans(skey)
+            plans = get_user_plans(skey) if page is None else page.plans
 
             database.create_user(
                 get_session_value('id'),
@@ -331,11 +420,10 @@ def auth():
             )
             # no database queries before this point
 
-            for plan in plans:
-                try:
-                    database.safely_add_purchases(get_session_value('id'), get_formatted_spending(database.get_session_data(get_session_value('id')), plan[0]))
-                except Exception as e:
-                    log_to_console(f"Error adding purchases for {plan[0]}: {e}")
+            # the plans are imported in the background, the importing page shows their progress
+            importer.start(database.get_session_data(get_session_value('id')), [int(plan[0]) for plan in plans])
+            wason = str(request.args.get('wason', '/'))
+            return redirect(url_for('importing', next=wason if wason.startswith('/') else '/'))
 
     else:
         log_to_console("Did not provide an 'skey'")
@@ -370,7 +458,7 @@ def refresh_user():
                 uid=get_session_value('id'),
                 plan_id=plan[0],
                 plan_name=plan[1],
-                pid=time.time()
+                pid=database.meal_plan_pid(get_session_value('id'), plan[0])
             ) for plan in get_user_plans(skey)]
         )
     
@@ -0,0 +1,131 @@
+"""
+Times importing a full TigerSpend statement, buffered (download the whole
+body, decode it, split it, strptime every row, then insert everything at
+once) against streamed (parse rows as the body arrives and insert them in
+batches). A synthetic CSV statement is served from a local HTTP server.
+
+Reports rows/s, MB/s and the peak memory traced while importing.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_ingest --rows 20000 200000
+"""
+
+import argparse
+import csv
+import datetime
+import http.server
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('CURRENT_SEMESTER', '2225')
+
+from sqlalchemy.orm import Session
+
+import conn
+import database
+from client import get_client, run
+
+LOCATIONS = ['Gracie Dining', 'Commons OnDemand', 'Beanz', 'Market', 'Crossroads', 'SNACK 123', 'Brick City']
+
+def make_statement(rows, seed=0):
+    """Returns a CSV statement with the given number of rows, newest first, ending in a deposit"""
+    rng = random.Random(seed)
+    dt = datetime.datetime(2010, 7, 1)
+    balance = round(rows * 8.0, 2)
+    lines = [f"{dt.strftime('%m/%d/%Y %I:%M%p')},Deposit,-{balance:.2f},{balance:.2f}"]
+    for _ in range(rows - 1):
+        dt += datetime.timedelta(minutes=rng.randint(1, 479))
+        amount = round(rng.uniform(1, 15), 2)
+        balance = round(balance - amount, 2)
+        lines.append(f"{dt.strftime('%m/%d/%Y %I:%M%p')},{rng.choice(LOCATIONS)},{amount:.2f},{balance:.2f}")
+    lines.append("Date,Location,Amount,Balance")
+    lines.reverse()
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+def serve(body):
+    """Serves body for every GET on a local port, returns the server"""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def buffered_import(uid, plan_id):
+    """The import as it was before streaming: everything in memory at every step"""
+    response = run(get_client().get("/statementdetail.php", {'acct': plan_id}))
+    rows = list(csv.reader(response.text().splitlines()))
+    purchases = []
+    for item in rows:
+        if item[0] == "Date":
+            continue
+        date = datetime.datetime.strptime(item[0], "%m/%d/%Y %I:%M%p")
+        amount = -1 * float(item[2])
+        new_balance = float(item[3])
+        purchases.append(database.Purchases(uid=uid, dt=date, location=item[1], amount=amount,
+            new_balance=new_balance, plan_id=plan_id,
+            pid=database.purchase_pid(uid, plan_id, date, amount, new_balance)))
+    with Session(database.engine) as session:
+        session.query(database.Purchases).filter(database.Purchases.uid == uid).filter(
+            database.Purchases.plan_id == plan_id).delete()
+        session.add_all(purchases)
+        session.commit()
+    return len(purchases)
+
+def streamed_import(uid, plan_id, batch_size):
+    """The import as the sync runs it now"""
+    statement = conn.fetch_statement('benchmark', plan_id)
+    return database.safely_add_purchases(uid, plan_id, conn.iter_purchases(uid, plan_id, statement.rows), batch_size)
+
+def measure(function, *args):
+    """Returns (seconds, peak traced MB, result), timed and traced in separate
+    runs since tracing slows everything down"""
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 2 ** 20, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark statement imports")
+    parser.add_argument('--rows', type=int, nargs='+', default=[20000, 200000])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    database.Base.metadata.create_all(database.engine)
+    # fetch_statement prints every statement URL
+    conn.print = lambda *args, **kwargs: None
+
+    print(f"{'rows':>8}{'MB':>7}{'method':>10}{'seconds':>10}{'rows/s':>11}{'MB/s':>8}{'peak MB':>10}")
+    for rows in args.rows:
+        body = make_statement(rows)
+        server = serve(body)
+        get_client().base_url = f"http://127.0.0.1:{server.server_port}"
+        size = len(body) / 2 ** 20
+
+        for method, function, extra in (('buffered', buffered_import, ()),
+                ('streamed', streamed_import, (args.batch_size,))):
+            seconds, peak, count = measure(function, 'bench', 54, *extra)
+            print(f"{rows:>8}{size:>7.1f}{method:>10}{seconds:>10.2f}{count / seconds:>11.0f}"
+                f"{size / seconds:>8.2f}{peak:>10.1f}")
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
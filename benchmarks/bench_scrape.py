@@ -0,0 +1,102 @@
+"""
+Times reading the account info and meal plans out of a statementnew.php
+page with AccountPageParser against the two BeautifulSoup passes that
+login used to make, and checks that both give the same results.
+
+A synthetic page is used unless a saved page is given with --page.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_scrape [--page statementnew.html] [--rows 2000]
+"""
+
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from bs4 import BeautifulSoup
+
+from conn import parse_account_page
+from lib import get_meal_plan_name
+
+def make_page(rows, seed=0):
+    """Returns a statementnew.php like page with a transaction table of the given size"""
+    rng = random.Random(seed)
+    styles = "\n".join(f".rule-{i} {{ margin: {i}px; }}" for i in range(500))
+    table = "\n".join(
+        f"<tr class='row'><td>01/{rng.randint(1, 28):02d}/2023 10:{rng.randint(0, 59):02d}AM</td>"
+        f"<td>Gracie Dining</td><td>{rng.uniform(1, 15):.2f}</td><td><a href='#r{i}'>receipt</a></td></tr>"
+        for i in range(rows))
+    return f"""<!DOCTYPE html>
+<html><head><title>TigerSpend</title><style>{styles}</style>
+<script>var config = {{"cid": 105, "rows": {rows}}};</script></head>
+<body><div class="jsa_header"><div class="jsa_account-info panel">
+<div class="line">Name: <b>John Doe</b></div>
+<div class="line">Account: <b>XXXXXXXXXXXX1234</b></div>
+</div></div>
+<form><select id="select-account" name="acct">
+<option value="54">Tiger Bucks</option><option value="7">Dining Dollars</option>
+<option value="1">Some Plan</option></select></form>
+<table class="jsa_transactions">{table}</table>
+</body></html>""".encode()
+
+def soup_account_info(content):
+    """get_account_info before AccountPageParser"""
+    soup = BeautifulSoup(content, 'html.parser')
+    options = soup.find("div", {"class": "jsa_account-info"}).find_all("b")
+    name = options[0].getText().replace("'", "").split(" ")
+    options[1] = str(options[1]).strip("<b>")
+    options[1] = str(options[1]).strip("</b>")
+    return [
+        str(name[0][0]).lower() + str(name[1]).lower() + str(options[1]).strip('X'),
+        str(name[0]).replace("'", ""),
+        str(name[1]).replace("'", ""),
+    ]
+
+def soup_plans(content):
+    """get_user_plans before AccountPageParser"""
+    soup = BeautifulSoup(content, 'html.parser')
+    options = soup.find(id="select-account").find_all('option')
+    return [(plan.attrs['value'], get_meal_plan_name(int(plan.attrs['value']))) for plan in options]
+
+def soup_login(content):
+    """Both passes login used to make over the same page"""
+    return soup_account_info(content), soup_plans(content)
+
+def best_of(function, repeat, *args):
+    """Returns the fastest of repeat runs, in milliseconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark account page scraping")
+    parser.add_argument('--page', help="saved statementnew.php page to parse")
+    parser.add_argument('--rows', type=int, default=2000, help="transactions on the synthetic page")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.page:
+        with open(args.page, 'rb') as page:
+            content = page.read()
+    else:
+        content = make_page(args.rows)
+
+    expected = soup_login(content)
+    page = parse_account_page(content)
+    if (page.account_info, page.plans) != expected:
+        raise SystemExit(f"Results differ!\n  soup:   {expected}\n  parser: {tuple(page)}")
+    print(f"page: {len(content) / 1024:.0f} KiB, account {page.account_info}, {len(page.plans)} plans")
+
+    soup_ms = best_of(soup_login, args.repeat, content)
+    parser_ms = best_of(parse_account_page, args.repeat, content)
+    print(f"{'BeautifulSoup x2 (ms)':>22}{'AccountPageParser (ms)':>24}{'speedup':>10}")
+    print(f"{soup_ms:>22.2f}{parser_ms:>24.2f}{soup_ms / parser_ms:>9.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Seeded synthetic purchase histories for the benchmarks.
+
+A history spreads its purchases over a few meal plans and up to twelve
+semesters, the last one ending today; larger histories are spent faster
+rather than over more years. Every plan
+gets a deposit when a semester starts and is spent down during it, with more
+purchases around meal times and fewer on weekends, at the locations found on
+real statements. The same size and seed always give the same history.
+"""
+
+import datetime
+import random
+
+import database
+from locations import classify_location
+
+# (plan id, purchases per weekday, semester deposit)
+PLANS = [(54, 2.5, 2800.0), (1, 0.6, 700.0), (24, 0.4, 450.0)]
+
+# (location code, weight, smallest amount, largest amount)
+LOCATIONS = [
+    ("Gracie Dining", 30, 6.0, 14.0),
+    ("Commons Dining", 18, 5.0, 13.0),
+    ("Commons OnDemand", 8, 6.0, 15.0),
+    ("Beanz Coffee", 10, 2.5, 7.0),
+    ("Global Village Market", 8, 3.0, 25.0),
+    ("C&M Crossroads", 7, 3.0, 30.0),
+    ("Brick City Cafe", 5, 5.0, 12.0),
+    ("Ctrl Alt DELi", 4, 7.0, 13.0),
+    ("Midnight Oil", 4, 2.0, 8.0),
+    ("SNACK 1207", 3, 1.25, 3.0),
+    ("BEVERAGE 0412", 3, 1.75, 3.5),
+]
+
+LOCATION_WEIGHTS = [weight for _, weight, _, _ in LOCATIONS]
+
+# hours of the day, weighted towards meal times
+HOUR_VALUES = list(range(7, 24))
+HOUR_WEIGHTS = [2, 5, 4, 3, 6, 10, 8, 4, 3, 3, 7, 9, 6, 4, 3, 2, 1]
+
+# share of a weekday's purchases made on a weekend day
+WEEKEND_RATE = 0.6
+
+SEMESTER_DAYS = 115
+MAX_SEMESTERS = 12
+# breaks before the semesters, going back from the current one
+BREAK_DAYS = (95, 30)
+
+def get_semesters(count, end):
+    """Returns count (first day, last day) semesters, oldest first, the last one ending on end"""
+    semesters = []
+    last = end
+    for i in range(count):
+        first = last - datetime.timedelta(days=SEMESTER_DAYS - 1)
+        semesters.append((first, last))
+        last = first - datetime.timedelta(days=BREAK_DAYS[i % 2] + 1)
+    semesters.reverse()
+    return semesters
+
+def make_purchase(uid, plan_id, dt, location, amount, new_balance):
+    """Returns a Purchases row as the sync stores it"""
+    classified = classify_location(location)
+    return database.Purchases(uid=uid, dt=dt, location=location, amount=amount, new_balance=new_balance,
+        plan_id=plan_id, pid=database.purchase_pid(uid, plan_id, dt, amount, new_balance),
+        location_name=classified.name, category=classified.category, online=classified.online)
+
+def generate_history(uid, rows, seed=0, end=None, plans=PLANS):
+    """Returns {plan_id: purchases, newest first} with rows purchases in total, deposits included"""
+    rng = random.Random(seed)
+    end = end or datetime.date.today()
+    # purchases expected per semester, larger histories are spent faster rather than over more years
+    per_semester = sum(rate for _, rate, _ in plans) * (5 + 2 * WEEKEND_RATE) / 7 * SEMESTER_DAYS + len(plans)
+    count = min(MAX_SEMESTERS, int(rows / per_semester) + 2)
+    scale = max(1.0, rows / (per_semester * (count - 1)))
+
+    purchases = []
+    for plan_id, rate, deposit in plans:
+        rate, deposit = rate * scale, round(deposit * scale, 2)
+        balance = 0.0
+        for first, last in get_semesters(count, end):
+            balance = round(balance + deposit, 2)
+            purchases.append(make_purchase(uid, plan_id, datetime.datetime.combine(first, datetime.time()),
+                "Deposit", -deposit, balance))
+            day = first
+            while day <= last:
+                day_rate = rate * WEEKEND_RATE if day.weekday() >= 5 else rate
+                times = sorted((rng.choices(HOUR_VALUES, HOUR_WEIGHTS)[0], rng.randrange(60))
+                    for _ in range(int(day_rate) + (rng.random() < day_rate % 1)))
+                for hour, minute in times:
+                    location, _, low, high = rng.choices(LOCATIONS, LOCATION_WEIGHTS)[0]
+                    amount = round(rng.uniform(low, high), 2)
+                    # declined once the plan runs dry
+                    if amount > balance:
+                        continue
+                    balance = round(balance - amount, 2)
+                    purchases.append(make_purchase(uid, plan_id, datetime.datetime.combine(day, datetime.time(hour, minute)),
+                        location, amount, balance))
+                day += datetime.timedelta(days=1)
+
+    # the oldest purchases are dropped to get to the requested size, the deposits are kept
+    # since statements always go back to the first one
+    purchases.sort(key=lambda purchase: purchase.dt)
+    excess = len(purchases) - rows
+    kept = []
+    for purchase in purchases:
+        if excess > 0 and purchase.location != "Deposit":
+            excess -= 1
+            continue
+        kept.append(purchase)
+
+    history = {}
+    for purchase in reversed(kept):
+        history.setdefault(purchase.plan_id, []).append(purchase)
+    return history
+
+def to_statement(purchases):
+    """Returns purchases, newest first, as the CSV statement TigerSpend serves for them"""
+    lines = ["Date,Location,Amount,Balance"]
+    for purchase in purchases:
+        lines.append(f"{purchase.dt.strftime('%m/%d/%Y %I:%M%p')},{purchase.location},"
+            f"{-purchase.amount:.2f},{purchase.new_balance:.2f}")
+    return "\r\n".join(lines) + "\r\n"
@@ -0,0 +1,181 @@
+"""
+Asynchronous TigerSpend client.
+
+Every request shares one keep-alive connection pool on a single event loop,
+so syncing many accounts does not pay a new TCP+TLS handshake per request.
+Synchronous code (Flask views, sync workers) goes through run().
+"""
+
+import asyncio
+import atexit
+import os
+import random
+import threading
+
+import aiohttp
+
+from metrics import upstream_seconds, upstream_retries
+
+BASE_URL = os.getenv("TIGERSPEND_URL", "https://tigerspend.rit.edu")
+
+
+class UpstreamError(Exception):
+    """Raised when TigerSpend could not be reached after every retry."""
+
+
+class Response:
+    """The parts of a TigerSpend response the rest of the app needs."""
+
+    def __init__(self, url, status, history, content, encoding):
+        self.url = url
+        self.status = status
+        self.history = history
+        self.content = content
+        self.encoding = encoding
+
+    def text(self):
+        """Return the decoded body"""
+        return self.content.decode(self.encoding)
+
+
+class StreamedResponse(Response):
+    """A response whose body is read chunk by chunk, it has to be closed once read."""
+
+    def __init__(self, response, semaphore):
+        super().__init__(
+            str(response.url),
+            response.status,
+            tuple(str(item.url) for item in response.history),
+            b"",
+            response.charset or "utf-8"
+        )
+        self.response = response
+        self.semaphore = semaphore
+
+    async def read_chunk(self, size=65536):
+        """Return the next chunk of the body, b'' once it has all been read"""
+        return await self.response.content.read(size)
+
+    async def close(self):
+        """Release the connection back to the pool"""
+        if self.semaphore is not None:
+            self.response.release()
+            self.semaphore.release()
+            self.semaphore = None
+
+
+class TigerSpendClient:
+    """Pooled HTTP client for TigerSpend with bounded concurrency,
+    timeouts and retries with exponential backoff."""
+
+    def __init__(self, base_url=BASE_URL,
+                 max_connections=int(os.getenv("TIGERSPEND_MAX_CONNECTIONS", "32")),
+                 max_concurrency=int(os.getenv("TIGERSPEND_CONCURRENCY", "16")),
+                 timeout=float(os.getenv("TIGERSPEND_TIMEOUT", "20")),
+                 retries=int(os.getenv("TIGERSPEND_RETRIES", "3")),
+                 backoff=0.5):
+        self.base_url = base_url.rstrip("/")
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        self.semaphore = None
+
+    async def open(self):
+        """Create the pooled session, this has to happen on the loop that uses it"""
+        if self.session is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+    async def close(self):
+        """Close every pooled connection"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, path, params=None):
+        """GET a TigerSpend page, retrying connection errors and 5xx responses."""
+        await self.open()
+        url = self.base_url + path
+
+        async with self.semaphore:
+            with upstream_seconds.time(path=path, outcome='error') as labels:
+                for attempt in range(self.retries + 1):
+                    try:
+                        async with self.session.get(url, params=params) as response:
+                            if response.status >= 500:
+                                raise aiohttp.ClientResponseError(
+                                    response.request_info, response.history,
+                                    status=response.status, message=response.reason)
+                            labels['outcome'] = response.status
+                            return Response(
+                                str(response.url),
+                                response.status,
+                                tuple(str(item.url) for item in response.history),
+                                await response.read(),
+                                response.charset or "utf-8"
+                            )
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                        if attempt == self.retries:
+                            raise UpstreamError(f"GET {path} failed after {attempt + 1} attempts: {ex!r}") from ex
+                    upstream_retries.inc(path=path)
+                    # full jitter keeps retrying workers from hitting TigerSpend in lockstep
+                    await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    async def stream(self, path, params=None):
+        """GET a TigerSpend page without reading its body, retrying like get()
+        until the response headers arrive. The returned StreamedResponse
+        holds a connection until it is closed.
+        The body may be read slowly, so the timeout applies to each read
+        instead of the whole request."""
+        await self.open()
+        url = self.base_url + path
+
+        await self.semaphore.acquire()
+        try:
+            with upstream_seconds.time(path=path, outcome='error') as labels:
+                for attempt in range(self.retries + 1):
+                    try:
+                        response = await self.session.get(url, params=params, timeout=aiohttp.ClientTimeout(
+                            total=None, sock_connect=self.timeout, sock_read=self.timeout))
+                        if response.status >= 500:
+                            response.release()
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, response.history,
+                                status=response.status, message=response.reason)
+                        labels['outcome'] = response.status
+                        return StreamedResponse(response, self.semaphore)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                        if attempt == self.retries:
+                            raise UpstreamError(f"GET {path} failed after {attempt + 1} attempts: {ex!r}") from ex
+                    upstream_retries.inc(path=path)
+                    await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+
+_loop = None
+_client = None
+_lock = threading.Lock()
+
+def get_client():
+    """Return the shared client, starting its event loop thread on first use"""
+    global _loop, _client
+    with _lock:
+        if _client is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True, name='TigerSpendClient').start()
+            _client = TigerSpendClient()
+            atexit.register(lambda: run(_client.close()))
+    return _client
+
+def run(coro):
+    """Run a client coroutine on the shared event loop and wait for its result"""
+    get_client()
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
@@ -1,7 +1,14 @@
 import requests
-import time
 import os
+import codecs
+import re
 import csv
+import itertools
+import smtplib
+import threading
+from email.message import EmailMessage
+from enum import Enum
+from typing import Iterable, NamedTuple
 
 from lib import (
     log_to_console, 
@@ -12,11 +19,41 @@ from lib import (
     check_session_value
 )
 import database
+from client import get_client, run, UpstreamError
+from locations import classify_location
 
 from datetime import datetime
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
 from twilio.rest import Client
 
+class StatementStatus(Enum):
+    """Outcome of a statement request"""
+    OK = 'ok'
+    EXPIRED = 'expired'
+    UPSTREAM_ERROR = 'upstream_error'
+
+class AccountPage(NamedTuple):
+    """What TigerWallet reads from a user's statementnew.php page"""
+    account_info: list # [account_id, first_name, last_name], None if the page had none
+    plans: list # [(plan_id, plan_name)]
+
+class Statement(NamedTuple):
+    """A statement request's status, and an iterator over its CSV rows when it succeeded"""
+    status: StatementStatus
+    rows: Iterable
+
+def is_login_response(response):
+    """TigerSpend answers requests with an expired skey by redirecting to its login page"""
+    return len(response.history) != 0 or 'login' in response.url
+
+# the login form is the only TigerSpend page asking for a password or posting to login.php
+login_form_pattern = re.compile(r"""<input[^>]*type\s*=\s*["']?password|login\.php""", re.IGNORECASE)
+
+def is_login_page(lines, max_lines=500):
+    """Whether an HTML page served in place of a statement is TigerSpend's login form,
+    rather than a maintenance or error page. Reads at most max_lines lines of it."""
+    return any(login_form_pattern.search(line) for line in itertools.islice(lines, max_lines))
+
 def verify_skey_integrity(skey):
     """Verifies the integrity of the skey."""
 
@@ -25,28 +62,35 @@ def verify_skey_integrity(skey):
         'skey': skey,
         'acct': 1
     }
-    count = 0
-    while count < 10:
-        try:
-            response = requests.get(
-                "https://tigerspend.rit.edu/statementdetail.php",
-                payload
-            )
-            break
-        except ConnectionError:
-            # there has to be a better way to do this
-            # look into using something other than the
-            # vanilla requests library
-            count += 1
-        time.sleep(.1)
-
-    if len(response.history) != 0:
-        return False
-    return True
-
-def force_retrieve_spending(skey, acct, format_output = 'csv', cid = 105):
-    """Return user spending information.
-    This should be used very carefully, as it does not check for values."""
+    response = run(get_client().get("/statementdetail.php", payload))
+
+    return not is_login_response(response)
+
+def iter_lines(response, chunk_size=65536):
+    """Yield the decoded lines of a StreamedResponse as its body arrives,
+    closing the response once it has been read"""
+    decoder = codecs.getincrementaldecoder(response.encoding)(errors='replace')
+    pending = ''
+    try:
+        while True:
+            chunk = run(response.read_chunk(chunk_size))
+            if not chunk:
+                break
+            lines = (pending + decoder.decode(chunk)).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip('\r')
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            yield pending.rstrip('\r')
+    finally:
+        run(response.close())
+
+def fetch_statement(skey, acct, format_output = 'csv', cid = 105, start_date = first_date):
+    """Request a user's statement from start_date onwards.
+    An expired skey is detected from the statement response itself,
+    so no separate verification request is needed.
+    The rows of an OK statement are parsed lazily while the body downloads."""
 
     _, _, end_date = [date.strftime("%Y-%m-%d") for date in get_datetimes()]
 
@@ -54,59 +98,100 @@ def force_retrieve_spending(skey, acct, format_output = 'csv', cid = 105):
     payload = {
         'skey': skey,
         'format': format_output,
-        'startdate': first_date.strftime("%Y-%m-%d"),
+        'startdate': start_date.strftime("%Y-%m-%d"),
         'enddate': end_date,
         'acct': acct,
         'cid': cid
     }
     try:
-        response = requests.get(
-            "https://tigerspend.rit.edu/statementdetail.php",
-            payload
-        )
-    except requests.exceptions.ConnectionError:
-        log_to_console("Failed to connect to TigerSpend!")
-        return '[]'
+        response = run(get_client().stream("/statementdetail.php", payload))
+    except UpstreamError as ex:
+        print (f"Failed to connect to TigerSpend! {ex}")
+        return Statement(StatementStatus.UPSTREAM_ERROR, [])
 
     print (response.url)
 
-    lines = response.content.decode(response.encoding).splitlines()
-    reader = csv.reader(lines)
-    result = list(reader)
-    #try:
-    #    json_result = json.loads(result)
-    #except json.JSONDecodeError:
-    #    print (f'failed lol {result}')
-    #    return '[]'
-
-    return result
-
-def get_formatted_spending(sess_data: database.SessionData, plan_id: int):
-    """Return an array of spending information in the form of Purchase items"""
-    response = force_retrieve_spending(sess_data.skey, plan_id)
+    if is_login_response(response) or response.status != 200:
+        run(response.close())
+        if is_login_response(response):
+            return Statement(StatementStatus.EXPIRED, [])
+        return Statement(StatementStatus.UPSTREAM_ERROR, [])
+
+    lines = iter_lines(response)
+    first_line = next(lines, '')
+    if first_line.lstrip().startswith('<'):
+        # an HTML page in place of the CSV is either the login form or a maintenance
+        # or error page, only the login form means the skey has expired
+        expired = is_login_page(itertools.chain([first_line], lines))
+        lines.close()
+        if expired:
+            return Statement(StatementStatus.EXPIRED, [])
+        print (f"TigerSpend answered with an HTML page in place of a statement for {acct}")
+        return Statement(StatementStatus.UPSTREAM_ERROR, [])
+
+    return Statement(StatementStatus.OK, csv.reader(itertools.chain([first_line], lines)))
+
+def force_retrieve_spending(skey, acct, format_output = 'csv', cid = 105, start_date = first_date):
+    """Return user spending information from start_date onwards.
+    This should be used very carefully, as it does not check for values."""
+    return list(fetch_statement(skey, acct, format_output, cid, start_date).rows)
 
-    result = []
-    for item in response:
-        if item[0] == "Date":
+def parse_timestamp(value):
+    """Parses TigerSpend's "%m/%d/%Y %I:%M%p" timestamps without going through strptime"""
+    try:
+        date, clock = value.split(' ')
+        month, day, year = date.split('/')
+        hour, minute = clock[:-2].split(':')
+        hour = int(hour) % 12
+        if clock[-2:].upper() == 'PM':
+            hour += 12
+        return datetime(int(year), int(month), int(day), hour, int(minute))
+    except ValueError:
+        return datetime.strptime(value, "%m/%d/%Y %I:%M%p")
+
+def iter_purchases(uid: str, plan_id: int, rows):
+    """Yield statement rows in the form of Purchase items, stopping at
+    TigerSpend's "no transactions" row"""
+    for item in rows:
+        if not item or item[0] == "Date":
             continue
         if 'transaction' in item[0]:
-            return None
-        date = datetime.strptime(item[0], "%m/%d/%Y %I:%M%p")
+            return
+        date = parse_timestamp(item[0])
         location = item[1]
         amount = -1 * float(item[2])
         new_balance = float(item[3])
+        # classified here once, so nothing that reads the purchase has to
+        classified = classify_location(location)
 
-        result.append(database.Purchases(
-            uid=sess_data.uid,
+        yield database.Purchases(
+            uid=uid,
             dt=date,
             location=location,
             amount=amount,
             new_balance=new_balance,
             plan_id=plan_id,
-            pid=time.time()
-        ))
+            pid=database.purchase_pid(uid, plan_id, date, amount, new_balance),
+            location_name=classified.name,
+            category=classified.category,
+            online=classified.online
+        )
+
+def format_spending(uid: str, plan_id: int, rows):
+    """Return statement rows in the form of Purchase items, None if there are none"""
+    return list(iter_purchases(uid, plan_id, rows)) or None
+
+def get_formatted_spending(sess_data: database.SessionData, plan_id: int, since: datetime = first_date):
+    """Return an array of spending information in the form of Purchase items.
+    Only the days from since onwards are requested from TigerSpend."""
+    return format_spending(sess_data.uid, plan_id, fetch_statement(sess_data.skey, plan_id, start_date=since).rows)
 
-    return result
+def get_statement_spending(sess_data: database.SessionData, plan_id: int, since: datetime = first_date):
+    """Like get_formatted_spending, but also returns the StatementStatus of the request.
+    The purchases are yielded as the statement downloads, so a full history
+    can be stored without ever holding all of it in memory."""
+    statement = fetch_statement(sess_data.skey, plan_id, start_date=since)
+    return statement.status, iter_purchases(sess_data.uid, plan_id, statement.rows)
 
 def post_to_pings(subject_uuid, username, body):
     """POST to pings.csh.rit.edu (created by Ethan Fergussen | @ethanf108)"""
@@ -122,7 +207,7 @@ def post_to_pings(subject_uuid, username, body):
 
     try:
         response = requests.post(
-            f"https://pings.csh.rit.edu/service/route/{subject_uuid}/ping",
+            f"{os.getenv('PINGS_URL', 'https://pings.csh.rit.edu')}/service/route/{subject_uuid}/ping",
             timeout=7,
             headers=headers,
             json=payload
@@ -133,24 +218,95 @@ def post_to_pings(subject_uuid, username, body):
 
     return response.status_code
 
-def get_user_plans(skey, cid=105):
-    """Get a list of all the user's plans and return the first one."""
+class AccountPageParser(HTMLParser):
+    """Collects the #select-account options and the jsa_account-info <b> tags
+    of a statementnew.php page, everything else on the page is skipped."""
+
+    def __init__(self):
+        super().__init__()
+        self.plan_values = []
+        self.info = []
+        self.in_select = False
+        self.info_depth = 0 # open <div>s since the jsa_account-info one, 0 when outside it
+        self.bold = None
+        self.found_select = False
+        self.found_info = False
+
+    @property
+    def done(self):
+        """Whether both parts of the page have been read"""
+        return self.found_select and self.found_info
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'select' and attrs.get('id') == 'select-account':
+            self.in_select = True
+        elif tag == 'option' and self.in_select and 'value' in attrs:
+            self.plan_values.append(attrs['value'])
+        elif tag == 'div':
+            if self.info_depth:
+                self.info_depth += 1
+            elif 'jsa_account-info' in (attrs.get('class') or '').split():
+                self.info_depth = 1
+        elif tag == 'b' and self.info_depth:
+            self.bold = []
+
+    def handle_endtag(self, tag):
+        if tag == 'select' and self.in_select:
+            self.in_select = False
+            self.found_select = True
+        elif tag == 'div' and self.info_depth:
+            self.info_depth -= 1
+            self.found_info = self.info_depth == 0
+        elif tag == 'b' and self.bold is not None:
+            self.info.append(''.join(self.bold))
+            self.bold = None
+
+    def handle_data(self, data):
+        if self.bold is not None:
+            self.bold.append(data)
+
+def parse_account_page(content: bytes, chunk_size=16384):
+    """Return the AccountPage found in a statementnew.php page,
+    parsing stops as soon as both the plans and the account info were read"""
+    parser = AccountPageParser()
+    text = content.decode('utf-8', errors='replace')
+    for start in range(0, len(text), chunk_size):
+        parser.feed(text[start:start + chunk_size])
+        if parser.done:
+            break
+    else:
+        parser.close()
+
+    account_info = None
+    if len(parser.info) >= 2:
+        name = parser.info[0].replace("'", "").split(" ")
+        account_info = [
+            name[0][0].lower() + name[1].lower() + parser.info[1].strip('X'), # account_id
+            name[0], # first_name
+            name[1], # last_name
+        ]
+
+    return AccountPage(account_info,
+        [(value, get_meal_plan_name(int(value))) for value in parser.plan_values])
+
+def get_account_page(skey, cid=105):
+    """Fetch and parse the user's account page, it holds both
+    their account information and their meal plans."""
 
     payload = {
         'skey': skey,
         'cid': cid
     }
-    response = requests.get(
-        "https://tigerspend.rit.edu/statementnew.php",
-        payload
-    )
-    soup = BeautifulSoup(response.content, 'html.parser')
-    try:
-        options = soup.find(id="select-account").find_all('option')
-    except AttributeError:
-        log_to_console(f"Ran into error while finding user accounts, {response.url}")
+    response = run(get_client().get("/statementnew.php", payload))
+    page = parse_account_page(response.content)
+    if page.account_info is None or not page.plans:
+        log_to_console(f"Ran into error while reading the account page, {response.url}")
+    return page
 
-    return [( plan.attrs['value'], get_meal_plan_name(int(plan.attrs['value'])) ) for plan in options]
+def get_user_plans(skey, cid=105):
+    """Get a list of all the user's plans."""
+    return get_account_page(skey, cid).plans
 
 def get_account_info(skey, cid=105):
     """Get the user's account information from their account page."""
@@ -162,41 +318,43 @@ def get_account_info(skey, cid=105):
             database.get_user(get_session_value("id")).last_name,
         ]
 
-    payload = {
-        'skey': skey,
-        'cid': cid
-    }
-    response = requests.get(
-        "https://tigerspend.rit.edu/statementnew.php", payload)
-
-    soup = BeautifulSoup(response.content, 'html.parser')
-    options = soup.find("div", {"class": "jsa_account-info"}).find_all("b")
-
-    name = options[0].getText().replace("'", "").split(" ")
-    options[1] = str(options[1]).strip("<b>")
-    options[1] = str(options[1]).strip("</b>") # lmao this is so cursed
+    return get_account_page(skey, cid).account_info # [account_id, first_name, last_name]
 
-    account_data = [
-        str(name[0][0]).lower() + str(name[1]).lower() + str(options[1]).strip('X'), # account_id
-        str(name[0]).replace("'", ""), # first_name
-        str(name[1]).replace("'", ""), # last_name
-    ]
+_twilio_client = None
+_twilio_lock = threading.Lock()
 
-    return account_data # [account_id, first_name, last_name]
+def get_twilio_client():
+    """Returns the Twilio client shared by every sender, creating it on first use"""
+    global _twilio_client
+    with _twilio_lock:
+        if _twilio_client is None:
+            _twilio_client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
+        return _twilio_client
 
 def send_twilio_message(phone_number, message):
     """Send a message to a phone number using Twilio."""
 
-    account_sid = os.getenv("TWILIO_ACCOUNT_SID")
-    auth_token = os.getenv("TWILIO_AUTH_TOKEN")
     twilio_number = os.getenv("TWILIO_NUMBER")
 
-    client = Client(account_sid, auth_token)
-
-    message = client.messages.create(
+    message = get_twilio_client().messages.create(
         to=f"+1{phone_number}",
         from_=f"+1{twilio_number}",
         body=message
     )
 
     return message
+
+def send_email(email_address, subject, body):
+    """Send an email through the SMTP server set in the environment."""
+
+    message = EmailMessage()
+    message['From'] = os.getenv("SMTP_FROM")
+    message['To'] = email_address
+    message['Subject'] = subject
+    message.set_content(body)
+
+    with smtplib.SMTP(os.getenv("SMTP_HOST", "localhost"), int(os.getenv("SMTP_PORT", "587")), timeout=10) as smtp:
+        if os.getenv("SMTP_USERNAME"):
+            smtp.starttls()
+            smtp.login(os.getenv("SMTP_USERNAME"), os.getenv("SMTP_PASSWORD"))
+        smtp.send_message(message)
@@ -1,16 +1,114 @@
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import String, DateTime, Float
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
-
+from sqlalchemy import String, Date, DateTime, Float
+from sqlalchemy import create_engine, func, insert, or_, select
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from contextlib import contextmanager
 import datetime
-from time import time
+import hashlib
+import itertools
+import pickle
+import tempfile
+import threading
+from time import perf_counter
+from typing import NamedTuple, Optional
 import os
 
-url = f"mysql://{os.environ['DB_USERNAME']}:{os.environ['DB_PASSWORD']}@{os.environ['DB_URL']}/{os.environ['DB_USERNAME']}"
-engine = create_engine(url)
+from locations import Location, classify_location
+
+# DATABASE_URL overrides the MySQL connection, e.g. sqlite:///bench.db for local benchmarks
+url = os.getenv('DATABASE_URL')
+if url is None:
+    url = f"mysql://{os.environ['DB_USERNAME']}:{os.environ['DB_PASSWORD']}@{os.environ['DB_URL']}/{os.environ['DB_USERNAME']}"
+
+class PoolMetrics:
+    """Counts connection checkouts and how long they waited for a free connection"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, waited, timed_out=False):
+        """Adds one checkout, or one that gave up after pool_timeout"""
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+pool_metrics = PoolMetrics()
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records checkout waits in pool_metrics"""
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.record(perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record(perf_counter() - start)
+        return connection
+
+def _pool_options():
+    """Connection pool settings, every web and sync worker process gets a pool of its own"""
+    if url.startswith('sqlite'):
+        # SQLite picks its own pool depending on whether the database is in memory
+        return {}
+    return {
+        'poolclass': MeteredQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', '30')),
+        # MySQL drops connections idle for longer than wait_timeout
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    }
+
+engine = create_engine(url, **_pool_options())
+
+# objects stay readable after the session that loaded them commits
+SessionFactory = sessionmaker(engine, expire_on_commit=False)
+
+@contextmanager
+def use_session(session: Session = None):
+    """Yields session if one is given, leaving committing it to the caller.
+    Otherwise yields a new session that is committed when the block finishes
+    and rolled back if it raises. Every helper below takes an optional session,
+    so a request or sync task can run several of them in one transaction."""
+    if session is not None:
+        yield session
+        return
+    with SessionFactory() as session:
+        yield session
+        session.commit()
+
+def get_pool_stats():
+    """Returns the pool's current state along with its checkout metrics"""
+    stats = {
+        'checkouts': pool_metrics.checkouts,
+        'timeouts': pool_metrics.timeouts,
+        'wait_seconds': round(pool_metrics.wait_seconds, 3),
+        'max_wait_seconds': round(pool_metrics.max_wait_seconds, 3),
+    }
+    pool = engine.pool
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+    return stats
+
+# rows sent per INSERT by the bulk writes below
+bulk_batch_size = int(os.getenv('DB_BATCH_SIZE', '1000'))
 
 class Base(DeclarativeBase):
     pass
@@ -38,9 +136,16 @@ class UserSettings(Base):
     balance_notifications: Mapped[bool] = mapped_column()
     email_address: Mapped[str] = mapped_column(String(64))
     phone_number: Mapped[str] = mapped_column(String(16))
+    balance_threshold: Mapped[Optional[float]] = mapped_column(Float)
 
     def __repr__(self):
-        return f'UserSettings(uid={self.uid}, credential_sync={self.credential_sync}, receipt_notifications={self.receipt_notifications}, balance_notifications={self.balance_notifications}, email_address={self.email_address}, phone_number={self.phone_number})'
+        return f'UserSettings(uid={self.uid}, credential_sync={self.credential_sync}, receipt_notifications={self.receipt_notifications}, balance_notifications={self.balance_notifications}, email_address={self.email_address}, phone_number={self.phone_number}, balance_threshold={self.balance_threshold})'
+
+    def get_balance_threshold(self):
+        """The balance that triggers an alert, BALANCE_THRESHOLD unless the user picked one"""
+        if self.balance_threshold is not None:
+            return self.balance_threshold
+        return float(os.getenv('BALANCE_THRESHOLD', '25'))
 
     def toJson(self):
         return {
@@ -49,11 +154,13 @@ class UserSettings(Base):
             'receipt_notifications': self.receipt_notifications,
             'balance_notifications': self.balance_notifications,
             'email_address': self.email_address,
-            'phone_number': self.phone_number
+            'phone_number': self.phone_number,
+            'balance_threshold': self.get_balance_threshold()
         }
 
 class Purchases(Base):
     __tablename__ = 'Purchases'
+    __table_args__ = (Index('ix_purchases_uid_plan_dt', 'uid', 'plan_id', 'dt'),)
 
     uid: Mapped[str] = mapped_column(String(37), ForeignKey('UserInfo.uid'))
     dt: Mapped[datetime.datetime] = mapped_column(DateTime)
@@ -62,12 +169,58 @@ class Purchases(Base):
     new_balance: Mapped[float] = mapped_column(Float)
     plan_id: Mapped[int] = mapped_column()
     pid: Mapped[str] = mapped_column(String(32), primary_key=True)
+    # the classified location, filled in when the purchase is synced
+    location_name: Mapped[Optional[str]] = mapped_column(String(64))
+    category: Mapped[Optional[str]] = mapped_column(String(16))
+    online: Mapped[Optional[bool]] = mapped_column()
+
+    def __repr__(self):
+        return f'Purchases(uid={self.uid}, dt={self.dt}, location={self.location}, amount={self.amount}, new_balance={self.new_balance}, pid={self.pid}, plan_id={self.plan_id}, location_name={self.location_name}, category={self.category}, online={self.online})'
+
+    @property
+    def display_location(self):
+        """The location as shown to users"""
+        if self.location_name is None:
+            # stored before locations were classified at sync time
+            return classify_location(self.location).display_name()
+        return Location(self.location_name, self.category, self.online).display_name()
+
+class SyncState(Base):
+    __tablename__ = 'SyncState'
+
+    uid: Mapped[str] = mapped_column(String(37), ForeignKey('UserInfo.uid'), primary_key=True)
+    plan_id: Mapped[int] = mapped_column(primary_key=True)
+    # the newest synced purchase, both None while the plan was found empty or its import failed
+    last_dt: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime)
+    last_balance: Mapped[Optional[float]] = mapped_column(Float)
+    synced_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+    import_failed: Mapped[Optional[bool]] = mapped_column()
+
+    @property
+    def imported(self):
+        """Whether any of the plan's purchases are stored"""
+        return self.last_dt is not None
 
     def __repr__(self):
-        return f'Purchases(uid={self.uid}, dt={self.dt}, location={self.location}, amount={self.amount}, new_balance={self.new_balance}, pid={self.pid}, plan_id={self.plan_id})'
+        return f'SyncState(uid={self.uid}, plan_id={self.plan_id}, last_dt={self.last_dt}, last_balance={self.last_balance}, synced_at={self.synced_at}, import_failed={self.import_failed})'
+
+# a plan's purchases summed per day, written in the same transaction as the purchases
+class DailySpending(Base):
+    __tablename__ = 'DailySpending'
+
+    uid: Mapped[str] = mapped_column(String(37), ForeignKey('UserInfo.uid'), primary_key=True)
+    plan_id: Mapped[int] = mapped_column(primary_key=True)
+    date: Mapped[datetime.date] = mapped_column(Date, primary_key=True)
+    total: Mapped[float] = mapped_column(Float)
+    count: Mapped[int] = mapped_column()
+    closing_balance: Mapped[float] = mapped_column(Float)
+
+    def __repr__(self):
+        return f'DailySpending(uid={self.uid}, plan_id={self.plan_id}, date={self.date}, total={self.total}, count={self.count}, closing_balance={self.closing_balance})'
 
 class SessionData(Base):
     __tablename__ = 'SessionData'
+    __table_args__ = (Index('ix_sessiondata_skey', 'skey', unique=True),)
 
     uid: Mapped[str] = mapped_column(String(37), ForeignKey('UserInfo.uid'), primary_key=True)
     theme: Mapped[str] = mapped_column()
@@ -79,6 +232,7 @@ class SessionData(Base):
 
 class MealPlans(Base):
     __tablename__ = 'MealPlans'
+    __table_args__ = (Index('ix_mealplans_uid', 'uid'),)
 
     uid: Mapped[str] = mapped_column(String(37), ForeignKey('UserInfo.uid'))
     plan_id: Mapped[int] = mapped_column()
@@ -89,9 +243,105 @@ class MealPlans(Base):
         return f'MealPlans(uid={self.uid}, plan_id={self.plan_id}, plan_name={self.plan_name}, pid={self.pid})'
 
 
-def create_user(uid: str, first_name: str, last_name: str, pref_name: str, skey: str, default_plan: int, plans):
+def purchase_pid(uid: str, plan_id: int, dt: datetime.datetime, amount: float, new_balance: float):
+    """Deterministic primary key for a purchase, so re-synced rows map onto the same pid"""
+    key = f'{uid}|{plan_id}|{dt.isoformat()}|{amount:.2f}|{new_balance:.2f}'
+    return hashlib.md5(key.encode()).hexdigest()
+
+def meal_plan_pid(uid: str, plan_id: int):
+    """Deterministic primary key for a user's meal plan, so storing a plan again replaces it"""
+    return hashlib.md5(f'{uid}|{plan_id}'.encode()).hexdigest()
+
+class SchedulerLease(Base):
+    __tablename__ = 'SchedulerLease'
+
+    name: Mapped[str] = mapped_column(String(32), primary_key=True)
+    holder: Mapped[str] = mapped_column(String(128))
+    expires_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+    def __repr__(self):
+        return f'SchedulerLease(name={self.name}, holder={self.holder}, expires_at={self.expires_at})'
+
+class RequestContext:
+    """Everything a page view needs to know about a user, loaded in one go"""
+
+    def __init__(self, user: UserInfo, session_data: SessionData, settings: UserSettings, meal_plans, sync_state: SyncState):
+        self.user = user
+        self.session_data = session_data
+        self.settings = settings
+        self.meal_plans = meal_plans
+        # None until the default plan's purchases have been stored
+        self.sync_state = sync_state
+
+    def __repr__(self):
+        return f'RequestContext(user={self.user}, session_data={self.session_data}, settings={self.settings}, meal_plans={len(self.meal_plans)}, sync_state={self.sync_state})'
+
+class SyncCandidate(NamedTuple):
+    """A user the background sync keeps up to date"""
+    session_data: SessionData
+    settings: UserSettings
+    plans: list # [(plan_id, SyncState or None)]
+
+def _sync_candidate_query():
+    return select(SessionData, UserSettings, MealPlans.plan_id, SyncState) \
+        .join(UserSettings, UserSettings.uid == SessionData.uid) \
+        .outerjoin(MealPlans, MealPlans.uid == SessionData.uid) \
+        .outerjoin(SyncState, (SyncState.uid == MealPlans.uid) & (SyncState.plan_id == MealPlans.plan_id)) \
+        .where(UserSettings.credential_sync.is_(True)) \
+        .order_by(SessionData.uid, MealPlans.plan_id)
+
+def _group_sync_candidates(rows):
+    for _, user_rows in itertools.groupby(rows, key=lambda row: row[0].uid):
+        user_rows = list(user_rows)
+        session_data, settings = user_rows[0][0], user_rows[0][1]
+        yield SyncCandidate(session_data, settings,
+            [(plan_id, state) for _, _, plan_id, state in user_rows if plan_id is not None])
+
+def get_sync_uids(session: Session = None):
+    """Returns the uid of every user with credential sync turned on"""
+    query = select(SessionData.uid).join(UserSettings, UserSettings.uid == SessionData.uid) \
+        .where(UserSettings.credential_sync.is_(True))
+    with use_session(session) as session:
+        return session.execute(query).scalars().all()
+
+def get_sync_candidates(uids, session: Session = None):
+    """Returns {uid: SyncCandidate} for the users as they are stored right now, in one
+    joined query. Users that are gone or turned credential sync off are left out."""
+    with use_session(session) as session:
+        rows = session.execute(_sync_candidate_query().where(SessionData.uid.in_(list(uids))))
+        return {candidate.session_data.uid: candidate for candidate in _group_sync_candidates(rows)}
+
+def load_request_context(uid: str, session: Session = None):
+    """Loads a user along with their session data, settings, meal plans
+    and the sync state of their default plan, on a single connection.
+    Returns None if the user doesn't exist."""
+    with use_session(session) as session:
+        row = session.query(UserInfo, SessionData, UserSettings, SyncState) \
+            .outerjoin(SessionData, SessionData.uid == UserInfo.uid) \
+            .outerjoin(UserSettings, UserSettings.uid == UserInfo.uid) \
+            .outerjoin(SyncState, (SyncState.uid == UserInfo.uid) & (SyncState.plan_id == SessionData.default_plan)
+                & SyncState.last_dt.isnot(None)) \
+            .filter(UserInfo.uid == uid).first()
+        if row is None:
+            return None
+        user, session_data, settings, sync_state = row
+
+        meal_plans = session.query(MealPlans).filter(MealPlans.uid == uid).all()
+        return RequestContext(user, session_data, settings, meal_plans, sync_state)
+
+def get_data_version(uid: str, session: Session = None):
+    """Returns (default_plan, number of meal plans, synced_at of the default plan),
+    which change whenever the data on a user's pages does, None if the user doesn't exist.
+    One indexed query, cheap enough to run before deciding whether to load anything else."""
+    plan_count = select(func.count(MealPlans.pid)).where(MealPlans.uid == SessionData.uid).scalar_subquery()
+    with use_session(session) as session:
+        return session.query(SessionData.default_plan, plan_count, SyncState.synced_at) \
+            .outerjoin(SyncState, (SyncState.uid == SessionData.uid) & (SyncState.plan_id == SessionData.default_plan)) \
+            .filter(SessionData.uid == uid).first()
+
+def create_user(uid: str, first_name: str, last_name: str, pref_name: str, skey: str, default_plan: int, plans, session: Session = None):
     """Creates User, session data, and fills in meal plans"""
-    with Session(engine) as session:
+    with use_session(session) as session:
         user = UserInfo(
             uid=uid,
             first_name=first_name,
@@ -106,12 +356,13 @@ def create_user(uid: str, first_name: str, last_name: str, pref_name: str, skey:
 
         session.add(user)
         session.add(user_settings)
-        session.commit()
-    create_session_data(uid, skey, default_plan)
-    replace_meal_plans(uid, [MealPlans(uid=uid, plan_id=plan[0], plan_name=plan[1], pid=time()) for plan in plans])
+        # the rows below reference the user
+        session.flush()
+        create_session_data(uid, skey, default_plan, session)
+        replace_meal_plans(uid, [MealPlans(uid=uid, plan_id=plan[0], plan_name=plan[1], pid=meal_plan_pid(uid, plan[0])) for plan in plans], session)
 
-def create_session_data(uid: str, skey: str, default_plan: int):
-    with Session(engine) as session:
+def create_session_data(uid: str, skey: str, default_plan: int, session: Session = None):
+    with use_session(session) as session:
         session_data = SessionData(
             uid=uid,
             theme='dark',
@@ -120,10 +371,9 @@ def create_session_data(uid: str, skey: str, default_plan: int):
         )
 
         session.add(session_data)
-        session.commit()
 
-def update_user(uid: str, first_name: str, last_name: str, pref_name: str, skey: str):
-    with Session(engine) as session:
+def update_user(uid: str, first_name: str, last_name: str, pref_name: str, skey: str, session: Session = None):
+    with use_session(session) as session:
         session.query(UserInfo).filter(UserInfo.uid == uid).update({
             UserInfo.first_name: first_name,
             UserInfo.last_name: last_name,
@@ -136,128 +386,439 @@ def update_user(uid: str, first_name: str, last_name: str, pref_name: str, skey:
             SessionData.skey: skey,
         })
 
-        session.commit()
-
-def remove_user(uid: str):
-    with Session(engine) as session:
+def remove_user(uid: str, session: Session = None):
+    with use_session(session) as session:
         session.query(MealPlans).filter(MealPlans.uid == uid).delete()
         session.query(SessionData).filter(SessionData.uid == uid).delete()
         session.query(Purchases).filter(Purchases.uid == uid).delete()
+        session.query(DailySpending).filter(DailySpending.uid == uid).delete()
+        session.query(SyncState).filter(SyncState.uid == uid).delete()
         session.query(UserSettings).filter(UserSettings.uid == uid).delete()
         session.query(UserInfo).filter(UserInfo.uid == uid).delete()
-        session.commit()
 
-def get_user(uid: str):
-    with Session(engine) as session:
+def get_user(uid: str, session: Session = None):
+    with use_session(session) as session:
         return session.query(UserInfo).filter(UserInfo.uid == uid).first()
 
-def get_user_with_skey(skey: str):
-    with Session(engine) as session:
+def get_user_with_skey(skey: str, session: Session = None):
+    with use_session(session) as session:
         return session.query(UserInfo).join(SessionData).filter(SessionData.skey == skey).first()
 
-def get_session_data(uid: str):
-    with Session(engine) as session:
+def get_session_data(uid: str, session: Session = None):
+    with use_session(session) as session:
         return session.query(SessionData).filter(SessionData.uid == uid).first()
 
-def get_meal_plans(uid: str):
-    with Session(engine) as session:
+def get_meal_plans(uid: str, session: Session = None):
+    with use_session(session) as session:
         return session.query(MealPlans).filter(MealPlans.uid == uid).all()
 
-def get_purchases(uid: str, plan_id: int):
-    with Session(engine) as session:
-        result = session.query(Purchases).filter(Purchases.uid == uid).filter(Purchases.plan_id == plan_id).all()
-        return result if result != [] else None
-
-def add_purchase(purchase: Purchases):
-    with Session(engine) as session:
+def _purchase_query(session: Session, uid: str, plan_id: int, since: datetime.datetime = None,
+        until: datetime.datetime = None):
+    """Query for the purchases of a plan with since <= dt < until,
+    a range scan of ix_purchases_uid_plan_dt"""
+    query = session.query(Purchases).filter(Purchases.uid == uid).filter(Purchases.plan_id == plan_id)
+    if since is not None:
+        query = query.filter(Purchases.dt >= since)
+    if until is not None:
+        query = query.filter(Purchases.dt < until)
+    return query
+
+def get_purchases(uid: str, plan_id: int, since: datetime.datetime = None, until: datetime.datetime = None,
+        limit: int = None, order: str = 'desc', session: Session = None):
+    """Returns the purchases of a plan with since <= dt < until, at most limit of them,
+    newest first or oldest first if order is 'asc'. None if there are none.
+    The window, order and limit are applied by the database."""
+    if order not in ('asc', 'desc'):
+        raise ValueError(f"order has to be 'asc' or 'desc', not {order!r}")
+    columns = (Purchases.dt, Purchases.pid) if order == 'asc' else (Purchases.dt.desc(), Purchases.pid.desc())
+    with use_session(session) as session:
+        query = _purchase_query(session, uid, plan_id, since, until).order_by(*columns)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all() or None
+
+def get_purchase_page(uid: str, plan_id: int, since: datetime.datetime = None, until: datetime.datetime = None,
+        before=None, limit: int = 100, session: Session = None):
+    """Returns up to limit purchases of a plan with since <= dt < until, newest first.
+    Pages are keyset paginated: before is the (dt, pid) of the last purchase
+    on the previous page, so every page is one index range scan."""
+    with use_session(session) as session:
+        query = _purchase_query(session, uid, plan_id, since, until)
+        if before is not None:
+            query = query.filter(or_(Purchases.dt < before[0], (Purchases.dt == before[0]) & (Purchases.pid < before[1])))
+        return query.order_by(Purchases.dt.desc(), Purchases.pid.desc()).limit(limit).all()
+
+def get_daily_spending(uid: str, plan_id: int, since: datetime.date = None, until: datetime.date = None,
+        session: Session = None):
+    """Returns the DailySpending rows of a plan with since <= date < until, newest first.
+    Only days with purchases have a row."""
+    with use_session(session) as session:
+        query = session.query(DailySpending).filter(DailySpending.uid == uid).filter(DailySpending.plan_id == plan_id)
+        if since is not None:
+            query = query.filter(DailySpending.date >= since)
+        if until is not None:
+            query = query.filter(DailySpending.date < until)
+        return query.order_by(DailySpending.date.desc()).all()
+
+def get_daily_totals(uid: str, plan_id: int, since: datetime.datetime = None, until: datetime.datetime = None,
+        session: Session = None):
+    """Returns (date, total, count) for every day of a plan with purchases
+    and since <= dt < until, newest first, read from the DailySpending rollups.
+    since and until are taken as the day they fall on."""
+    days = get_daily_spending(uid, plan_id, since.date() if since is not None else None,
+        until.date() if until is not None else None, session)
+    return [(day.date, round(day.total, 2), day.count) for day in days]
+
+def get_last_deposit(uid: str, plan_id: int, since: datetime.datetime, session: Session = None):
+    """Returns the newest deposit, or rollover move that left a balance, of a plan after since.
+    None if there was none."""
+    with use_session(session) as session:
+        return _purchase_query(session, uid, plan_id).filter(Purchases.dt > since) \
+            .filter(or_(Purchases.location == 'Deposit',
+                Purchases.location.contains('Moves', autoescape=True) & (Purchases.new_balance != 0))) \
+            .order_by(Purchases.dt.desc()).first()
+
+def add_purchase(purchase: Purchases, session: Session = None):
+    with use_session(session) as session:
         session.add(purchase)
-        session.commit()
-
-def safely_add_purchases(uid: str, purchases):
-    with Session(engine) as session:
-        session.query(Purchases).filter(Purchases.uid == uid).filter(Purchases.plan_id == purchases[0].plan_id).delete()
-        #print (f"DELETED {uid} {purchases[0].plan_id}")
-        session.add_all(purchases)
-        session.commit()
-
-def add_meal_plans(meal_plans):
-    with Session(engine) as session:
-        session.add_all(meal_plans)
-        session.commit()
 
-def replace_meal_plans(uid: str, meal_plans):
-    with Session(engine) as session:
+def _set_sync_state(session: Session, uid: str, plan_id: int, last_dt: datetime.datetime, last_balance: float):
+    """Moves a plan's watermark to its newest purchase, synced_at marks
+    the last time the plan's stored purchases changed"""
+    session.merge(SyncState(
+        uid=uid,
+        plan_id=plan_id,
+        last_dt=last_dt,
+        last_balance=last_balance,
+        synced_at=datetime.datetime.now(),
+        import_failed=False
+    ))
+
+def _set_unsynced_state(session: Session, uid: str, plan_id: int, failed: bool):
+    """Records that a plan's import found no purchases, or failed, so every process can
+    tell the import finished. Left alone once any of the plan's purchases are stored."""
+    state = session.get(SyncState, (uid, plan_id))
+    if state is None:
+        session.add(SyncState(uid=uid, plan_id=plan_id, last_dt=None, last_balance=None,
+            synced_at=datetime.datetime.now(), import_failed=failed))
+    elif not state.imported:
+        state.import_failed = failed
+        state.synced_at = datetime.datetime.now()
+
+def record_failed_import(uid: str, plan_id: int, session: Session = None):
+    """Records that a plan's import failed, the sync worker imports it later"""
+    with use_session(session) as session:
+        _set_unsynced_state(session, uid, plan_id, failed=True)
+
+def _batched(iterable, size):
+    """Yield lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _upsert(table, update_columns):
+    """INSERT for table that overwrites update_columns of rows whose primary key
+    is already stored: ON DUPLICATE KEY UPDATE on MySQL, ON CONFLICT on SQLite"""
+    if engine.dialect.name == 'mysql':
+        statement = mysql.insert(table)
+        return statement.on_duplicate_key_update({column: statement.inserted[column] for column in update_columns})
+    if engine.dialect.name == 'sqlite':
+        statement = sqlite.insert(table)
+        return statement.on_conflict_do_update(index_elements=[column.name for column in table.primary_key],
+            set_={column: statement.excluded[column] for column in update_columns})
+    return insert(table)
+
+_purchase_upsert = _upsert(Purchases.__table__,
+    ['uid', 'dt', 'location', 'amount', 'new_balance', 'plan_id', 'location_name', 'category', 'online'])
+_meal_plan_upsert = _upsert(MealPlans.__table__, ['uid', 'plan_id', 'plan_name'])
+_daily_spending_upsert = _upsert(DailySpending.__table__, ['total', 'count', 'closing_balance'])
+
+def _purchase_row(purchase):
+    return {
+        'uid': purchase.uid,
+        'dt': purchase.dt,
+        'location': purchase.location,
+        'amount': purchase.amount,
+        'new_balance': purchase.new_balance,
+        'plan_id': purchase.plan_id,
+        'pid': purchase.pid,
+        'location_name': purchase.location_name,
+        'category': purchase.category,
+        'online': purchase.online
+    }
+
+def bulk_add_purchases(session: Session, purchases, batch_size: int = None):
+    """Upserts purchases with executemany INSERTs of batch_size rows, skipping the
+    ORM unit of work. Returns the newest purchase written and the number of purchases."""
+    newest, count = None, 0
+    for batch in _batched(purchases, batch_size or bulk_batch_size):
+        session.execute(_purchase_upsert, [_purchase_row(purchase) for purchase in batch])
+        for purchase in batch:
+            if newest is None or purchase.dt > newest.dt:
+                newest = purchase
+        count += len(batch)
+    return newest, count
+
+def _stage_purchases(purchases, batch_size: int):
+    """Writes purchases to a temporary file as batches of rows, so a streamed statement
+    can be read to the end without holding it in memory or a database connection.
+    Returns the rewound file, the newest purchase and the number of purchases."""
+    staged = tempfile.TemporaryFile()
+    newest, count = None, 0
+    try:
+        for batch in _batched(purchases, batch_size):
+            pickle.dump([_purchase_row(purchase) for purchase in batch], staged)
+            for purchase in batch:
+                if newest is None or purchase.dt > newest.dt:
+                    newest = purchase
+            count += len(batch)
+    except BaseException:
+        staged.close()
+        raise
+    staged.seek(0)
+    return staged, newest, count
+
+def _iter_staged(staged):
+    """Yields the batches of rows written by _stage_purchases"""
+    while True:
+        try:
+            yield pickle.load(staged)
+        except EOFError:
+            return
+
+def update_daily_spending(session: Session, uid: str, plan_id: int, since: datetime.date = None):
+    """Recomputes a plan's DailySpending rows from the purchases stored for the days
+    from since on, or for every day if since is None. Returns the number of days written."""
+    query = select(Purchases.dt, Purchases.amount, Purchases.new_balance) \
+        .where(Purchases.uid == uid).where(Purchases.plan_id == plan_id)
+    stale = session.query(DailySpending).filter(DailySpending.uid == uid).filter(DailySpending.plan_id == plan_id)
+    if since is not None:
+        query = query.where(Purchases.dt >= datetime.datetime.combine(since, datetime.time()))
+        stale = stale.filter(DailySpending.date >= since)
+
+    # day -> [total, count, closing balance], the balance after the day's last purchase
+    days = {}
+    for dt, amount, new_balance in session.execute(query.order_by(Purchases.dt).execution_options(yield_per=bulk_batch_size)):
+        day = days.setdefault(dt.date(), [0.0, 0, new_balance])
+        day[0] += round(amount, 2)
+        day[1] += 1
+        day[2] = new_balance
+
+    stale.delete()
+    rows = [{'uid': uid, 'plan_id': plan_id, 'date': date, 'total': round(total, 2), 'count': count,
+        'closing_balance': closing_balance} for date, (total, count, closing_balance) in days.items()]
+    for batch in _batched(rows, bulk_batch_size):
+        session.execute(_daily_spending_upsert, batch)
+    return len(rows)
+
+def rebuild_daily_spending(uid: str = None):
+    """Recomputes every DailySpending row from the stored purchases, only uid's if given,
+    one plan per transaction. Returns the number of plans rebuilt."""
+    query = select(Purchases.uid, Purchases.plan_id).distinct()
+    if uid is not None:
+        query = query.where(Purchases.uid == uid)
+    with use_session() as session:
+        plans = session.execute(query).all()
+    for plan_uid, plan_id in plans:
+        with use_session() as session:
+            update_daily_spending(session, plan_uid, plan_id)
+            # moves the plan's data version along, so pages built from the old rows are not reused
+            session.query(SyncState).filter(SyncState.uid == plan_uid).filter(SyncState.plan_id == plan_id) \
+                .update({SyncState.synced_at: datetime.datetime.now()})
+    return len(plans)
+
+def classify_stored_locations():
+    """Stores the classified location of every purchase whose stored one is missing
+    or out of date with locations.location_table. Each location code is classified
+    once and written with one UPDATE. Returns the number of purchases changed."""
+    with use_session() as session:
+        codes = [code for (code,) in session.query(Purchases.location).distinct()]
+    changed = 0
+    for code in codes:
+        name, category, online = classify_location(code)
+        with use_session() as session:
+            changed += session.query(Purchases).filter(Purchases.location == code) \
+                .filter(or_(Purchases.location_name.is_(None), Purchases.location_name != name,
+                    Purchases.category != category, Purchases.online != online)) \
+                .update({Purchases.location_name: name, Purchases.category: category, Purchases.online: online},
+                    synchronize_session=False)
+    return changed
+
+def bulk_add_meal_plans(session: Session, meal_plans):
+    """Upserts meal plans in a single executemany INSERT"""
+    rows = [{'uid': plan.uid, 'plan_id': plan.plan_id, 'plan_name': plan.plan_name, 'pid': plan.pid}
+        for plan in meal_plans]
+    if rows:
+        session.execute(_meal_plan_upsert, rows)
+
+def safely_add_purchases(uid: str, plan_id: int, purchases, batch_size: int = None, session: Session = None):
+    """Replaces the full purchase history of a plan and resets its sync state.
+    purchases can be any iterable, it is staged to a temporary file batch_size rows
+    at a time so a streamed statement never has to be held in memory all at once,
+    and is read to the end before the old history is deleted.
+    Returns the number of purchases stored. An empty statement leaves the stored
+    purchases alone, it is only recorded for a plan that has none."""
+    staged, newest, count = _stage_purchases(purchases, batch_size or bulk_batch_size)
+    with staged:
+        if count == 0:
+            with use_session(session) as session:
+                _set_unsynced_state(session, uid, plan_id, failed=False)
+            return 0
+        with use_session(session) as session:
+            session.query(Purchases).filter(Purchases.uid == uid).filter(Purchases.plan_id == plan_id).delete()
+            for rows in _iter_staged(staged):
+                session.execute(_purchase_upsert, rows)
+            update_daily_spending(session, uid, plan_id)
+            _set_sync_state(session, uid, plan_id, newest.dt, newest.new_balance)
+    return count
+
+def get_unstored_purchases(purchases, session: Session = None):
+    """Returns the purchases whose pid is not stored yet, each pid once, in their original order"""
+    by_pid = {purchase.pid: purchase for purchase in purchases}
+    if not by_pid:
+        return []
+    with use_session(session) as session:
+        existing = {pid for (pid,) in session.query(Purchases.pid).filter(
+            Purchases.pid.in_(list(by_pid)))}
+    return [purchase for pid, purchase in by_pid.items() if pid not in existing]
+
+def sync_purchases(uid: str, plan_id: int, purchases, session: Session = None):
+    """Inserts the purchases that are not stored yet and moves the sync state forward.
+    Returns the newly inserted purchases, newest first."""
+    with use_session(session) as session:
+        by_pid = {purchase.pid: purchase for purchase in purchases}
+        added = get_unstored_purchases(by_pid.values(), session)
+        if not added:
+            return []
+        # an upsert, so a row written by another worker in the meantime is not an error
+        bulk_add_purchases(session, added)
+        # only the days the new purchases fell on change
+        update_daily_spending(session, uid, plan_id, min(purchase.dt for purchase in added).date())
+        # the watermark follows the newest purchase of the statement, not of the added ones,
+        # since TigerSpend can post an older purchase late, and it never moves backwards
+        newest = max(by_pid.values(), key=lambda purchase: purchase.dt)
+        state = session.get(SyncState, (uid, plan_id))
+        if state is not None and state.imported and state.last_dt > newest.dt:
+            state.synced_at = datetime.datetime.now()
+        else:
+            _set_sync_state(session, uid, plan_id, newest.dt, newest.new_balance)
+    added.sort(key=lambda p: p.dt, reverse=True)
+    return added
+
+def get_sync_state(uid: str, plan_id: int, session: Session = None):
+    with use_session(session) as session:
+        return session.query(SyncState).filter(SyncState.uid == uid).filter(SyncState.plan_id == plan_id).first()
+
+def get_sync_states(uid: str, session: Session = None):
+    """Returns the SyncState of every plan of the user whose import finished"""
+    with use_session(session) as session:
+        return session.query(SyncState).filter(SyncState.uid == uid).all()
+
+def add_meal_plans(meal_plans, session: Session = None):
+    with use_session(session) as session:
+        bulk_add_meal_plans(session, meal_plans)
+
+def replace_meal_plans(uid: str, meal_plans, session: Session = None):
+    with use_session(session) as session:
         session.query(MealPlans).filter(MealPlans.uid == uid).delete()
-        session.add_all(meal_plans)
-        session.commit()
+        bulk_add_meal_plans(session, meal_plans)
 
-def update_session_data(uid: str, theme: str, skey: str, default_plan: int):
-    with Session(engine) as session:
+def update_session_data(uid: str, theme: str, skey: str, default_plan: int, session: Session = None):
+    with use_session(session) as session:
         session.query(SessionData).filter(SessionData.uid == uid).update({
             SessionData.theme: theme,
             SessionData.skey: skey,
             SessionData.default_plan: default_plan
         })
-        session.commit()
 
-def log_user_auth(uid: str):
-    with Session(engine) as session:
+def log_user_auth(uid: str, session: Session = None):
+    with use_session(session) as session:
         session.query(UserInfo).filter(UserInfo.uid == uid).update({
             UserInfo.last_sign_in: datetime.datetime.now(),
             UserInfo.total_auths: UserInfo.total_auths + 1
         })
-        session.commit()
 
-def update_skey(uid: str, skey: str):
-    with Session(engine) as session:
+def update_skey(uid: str, skey: str, session: Session = None):
+    with use_session(session) as session:
         session.query(SessionData).filter(SessionData.uid == uid).update({
             SessionData.skey: skey
         })
-        session.commit()
 
-def user_exists(uid: str):
-    with Session(engine) as session:
+def user_exists(uid: str, session: Session = None):
+    with use_session(session) as session:
         return session.query(UserInfo).filter(UserInfo.uid == uid).first() is not None
 
-def change_user_theme(uid: str, theme: str):
-    with Session(engine) as session:
+def change_user_theme(uid: str, theme: str, session: Session = None):
+    with use_session(session) as session:
         session.query(SessionData).filter(SessionData.uid == uid).update({
             SessionData.theme: theme
         })
-        session.commit()
 
-def change_default_plan(uid: str, plan_id: int):
-    with Session(engine) as session:
+def change_default_plan(uid: str, plan_id: int, session: Session = None):
+    with use_session(session) as session:
         session.query(SessionData).filter(SessionData.uid == uid).update({
             SessionData.default_plan: plan_id
         })
-        session.commit()
 
-def get_number_of_users():
-    with Session(engine) as session:
+def get_number_of_users(session: Session = None):
+    with use_session(session) as session:
         return session.query(UserInfo).count()
 
-def get_number_of_purchases():
-    with Session(engine) as session:
+def get_number_of_purchases(session: Session = None):
+    with use_session(session) as session:
         return session.query(Purchases).count()
 
-def get_all_sessions():
-    with Session(engine) as session:
+def get_all_sessions(session: Session = None):
+    with use_session(session) as session:
         return session.query(SessionData).all()
 
-def change_email(uid: str, email_address: str):
-    with Session(engine) as session:
+def change_email(uid: str, email_address: str, session: Session = None):
+    with use_session(session) as session:
         session.query(UserSettings).filter(UserSettings.uid == uid).update({
             UserSettings.email_address: email_address
         })
-        session.commit()
 
-def update_user_settings(settings: UserSettings):
-    with Session(engine) as session:
+def update_user_settings(settings: UserSettings, session: Session = None):
+    with use_session(session) as session:
         session.query(UserSettings).filter(UserSettings.uid == settings.uid).delete()
         session.add(settings)
-        session.commit()
 
-def get_user_settings(uid: str):
-    with Session(engine) as session:
+def get_user_settings(uid: str, session: Session = None):
+    with use_session(session) as session:
         return session.query(UserSettings).filter(UserSettings.uid == uid).first()
+
+def acquire_lease(name: str, holder: str, seconds: float):
+    """Takes or renews the named lease for holder.
+    Returns True if holder owns the lease for the next given number of seconds."""
+    now = datetime.datetime.now()
+    expires_at = now + datetime.timedelta(seconds=seconds)
+    with SessionFactory() as session:
+        updated = session.query(SchedulerLease).filter(SchedulerLease.name == name) \
+            .filter(or_(SchedulerLease.holder == holder, SchedulerLease.expires_at < now)) \
+            .update({
+                SchedulerLease.holder: holder,
+                SchedulerLease.expires_at: expires_at
+            })
+        if updated:
+            session.commit()
+            return True
+        if session.get(SchedulerLease, name) is not None:
+            return False
+        try:
+            session.add(SchedulerLease(name=name, holder=holder, expires_at=expires_at))
+            session.commit()
+        except IntegrityError:
+            # another worker created the lease first
+            return False
+        return True
+
+def release_lease(name: str, holder: str):
+    """Gives up the named lease if holder owns it"""
+    with SessionFactory() as session:
+        session.query(SchedulerLease).filter(SchedulerLease.name == name) \
+            .filter(SchedulerLease.holder == holder) \
+            .update({SchedulerLease.expires_at: datetime.datetime.now()})
+        session.commit()
@@ -1,5 +1,8 @@
+-- Creates the baseline schema, run `python migrate.py` afterwards for indexes and later changes
+
 use TigerWallet;
 
+drop table IF EXISTS SyncState;
 drop table IF EXISTS Purchases;
 drop table IF EXISTS MealPlans;
 drop table IF EXISTS SessionData;
@@ -41,6 +44,17 @@ CREATE table Purchases (
     primary key (pid)
 );
 
+SHOW TABLES;
+CREATE table SyncState (
+	uid varchar(37),
+    plan_id int,
+    last_dt datetime,
+    last_balance decimal(7, 2),
+    synced_at datetime,
+    foreign key (uid) references UserInfo(uid),
+    primary key (uid, plan_id)
+);
+
 SHOW TABLES;
 CREATE table SessionData (
 	uid varchar(37),
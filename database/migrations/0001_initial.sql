@@ -0,0 +1,63 @@
+-- Baseline schema, safe to run against a database created by generate-db.sql
+
+CREATE TABLE IF NOT EXISTS UserInfo (
+    uid varchar(37),
+    first_name varchar(32),
+    last_name varchar(32),
+    pref_name varchar(32),
+    first_sign_in datetime,
+    last_sign_in datetime,
+    total_auths int DEFAULT 0,
+    primary key (uid)
+);
+
+CREATE TABLE IF NOT EXISTS UserSettings (
+    uid varchar(37),
+    credential_sync boolean,
+    receipt_notifications boolean,
+    balance_notifications boolean,
+    email_address varchar(64),
+    phone_number varchar(16),
+    foreign key (uid) references UserInfo(uid),
+    primary key (uid)
+);
+
+CREATE TABLE IF NOT EXISTS MealPlans (
+    uid varchar(37),
+    plan_id int,
+    plan_name varchar(64),
+    pid varchar(32),
+    foreign key (uid) references UserInfo(uid),
+    primary key (pid)
+);
+
+CREATE TABLE IF NOT EXISTS Purchases (
+    uid varchar(37),
+    dt datetime,
+    location varchar(64),
+    amount decimal(6, 2),
+    new_balance decimal(7, 2),
+    plan_id int,
+    pid varchar(32),
+    foreign key (uid) references UserInfo(uid),
+    primary key (pid)
+);
+
+CREATE TABLE IF NOT EXISTS SyncState (
+    uid varchar(37),
+    plan_id int,
+    last_dt datetime,
+    last_balance decimal(7, 2),
+    synced_at datetime,
+    foreign key (uid) references UserInfo(uid),
+    primary key (uid, plan_id)
+);
+
+CREATE TABLE IF NOT EXISTS SessionData (
+    uid varchar(37),
+    theme varchar(16) DEFAULT 'dark',
+    skey varchar(32),
+    default_plan int,
+    primary key (uid),
+    foreign key (uid) references UserInfo(uid)
+);
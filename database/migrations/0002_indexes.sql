@@ -0,0 +1,8 @@
+-- Indexes for the hot queries: purchases by (uid, plan_id) ordered or windowed by dt,
+-- users looked up by skey, and meal plans by uid
+
+CREATE INDEX ix_purchases_uid_plan_dt ON Purchases (uid, plan_id, dt);
+
+CREATE UNIQUE INDEX ix_sessiondata_skey ON SessionData (skey);
+
+CREATE INDEX ix_mealplans_uid ON MealPlans (uid);
@@ -0,0 +1,8 @@
+-- Lease held by the one sync worker allowed to run the scheduler
+
+CREATE TABLE SchedulerLease (
+    name varchar(32),
+    holder varchar(128),
+    expires_at datetime,
+    primary key (name)
+);
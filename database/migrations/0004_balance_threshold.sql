@@ -0,0 +1,3 @@
+-- Balance below which users with balance notifications get an alert, NULL uses BALANCE_THRESHOLD
+
+ALTER TABLE UserSettings ADD COLUMN balance_threshold float;
@@ -0,0 +1,13 @@
+-- Purchases summed per plan and day, kept up to date by the sync.
+-- Fill it for the purchases already stored with: python worker.py --rebuild-rollups
+
+CREATE TABLE DailySpending (
+    uid varchar(37),
+    plan_id int,
+    date date,
+    total decimal(8, 2),
+    count int,
+    closing_balance decimal(7, 2),
+    foreign key (uid) references UserInfo(uid),
+    primary key (uid, plan_id, date)
+);
@@ -0,0 +1,6 @@
+-- Locations classified when purchases are synced.
+-- Fill them in for the purchases already stored with: python worker.py --classify-locations
+
+ALTER TABLE Purchases ADD COLUMN location_name varchar(64);
+ALTER TABLE Purchases ADD COLUMN category varchar(16);
+ALTER TABLE Purchases ADD COLUMN online boolean;
@@ -0,0 +1,4 @@
+-- Plans whose import found no purchases, or failed, get a SyncState without a watermark,
+-- so every process can tell their import finished
+
+ALTER TABLE SyncState ADD COLUMN import_failed boolean;
@@ -0,0 +1,91 @@
+"""
+First-login imports.
+
+A new user's plans are imported in the background, all at the same time,
+so signing in never waits on TigerSpend. Which plans are done is read from
+their SyncState rows, so any web process can report the progress of an
+import. Plans that turned out to be empty or failed to import get a SyncState
+without a watermark, which the sync worker imports again like a plan
+that was never synced.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from conn import get_statement_spending, StatementStatus
+from metrics import sync_task_seconds
+import database
+
+# what became of a plan's import
+RUNNING = 'running'
+IMPORTED = 'imported'
+EMPTY = 'empty'
+FAILED = 'failed'
+
+
+class Importer:
+    """Imports the full history of new users' plans on a pool of threads."""
+
+    def __init__(self, threads=4, keep_seconds=600):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='Importer')
+        self.keep_seconds = keep_seconds
+        self.lock = threading.Lock()
+        self.jobs = {} # uid -> {plan_id: status}
+        self.finished_at = {} # uid -> when their last plan finished
+
+    def start(self, session_data: database.SessionData, plan_ids):
+        """Starts importing each of the plans, plans already being imported are left alone"""
+        with self.lock:
+            self._forget_finished()
+            statuses = self.jobs.setdefault(session_data.uid, {})
+            self.finished_at.pop(session_data.uid, None)
+            for plan_id in plan_ids:
+                if statuses.get(plan_id) == RUNNING:
+                    continue
+                statuses[plan_id] = RUNNING
+                self.executor.submit(self._import, session_data, plan_id)
+
+    def get_statuses(self, uid: str):
+        """Returns {plan_id: status} for the user's plans imported by this process"""
+        with self.lock:
+            return dict(self.jobs.get(uid, {}))
+
+    def _forget_finished(self):
+        """Drops the statuses of imports that finished a while ago"""
+        now = time.monotonic()
+        for uid, finished in list(self.finished_at.items()):
+            if now - finished > self.keep_seconds:
+                del self.finished_at[uid]
+                self.jobs.pop(uid, None)
+
+    def _import(self, session_data: database.SessionData, plan_id: int):
+        with sync_task_seconds.time(task='import', outcome=FAILED) as labels:
+            try:
+                status, purchases = get_statement_spending(session_data, plan_id)
+                if status is StatementStatus.OK:
+                    count = database.safely_add_purchases(session_data.uid, plan_id, purchases)
+                    result = IMPORTED if count else EMPTY
+                    print (f"Imported {count} purchases for {session_data.uid} | {plan_id}")
+                else:
+                    result = FAILED
+                    print (f"Could not import {session_data.uid} | {plan_id}: {status.name}")
+            except Exception as e:
+                result = FAILED
+                print (f"Failed to import {session_data.uid} | {plan_id}! {e}")
+            if result == FAILED:
+                try:
+                    database.record_failed_import(session_data.uid, plan_id)
+                except Exception as e:
+                    print (f"Could not record the failed import of {session_data.uid} | {plan_id}! {e}")
+            labels['outcome'] = result
+
+        with self.lock:
+            statuses = self.jobs.setdefault(session_data.uid, {})
+            statuses[plan_id] = result
+            if RUNNING not in statuses.values():
+                self.finished_at[session_data.uid] = time.monotonic()
+
+
+importer = Importer(threads=int(os.getenv('IMPORT_THREADS', '4')))
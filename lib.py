@@ -3,7 +3,7 @@ import os
 
 import database
 
-from flask import session, request
+from flask import session, request, g
 
 # dictionary of datetimes for all semesters
 # select the currect semester with evironmental variables
@@ -36,14 +36,6 @@ def get_date_strings():
         semester_times[int(os.getenv("CURRENT_SEMESTER"))]["end"].strftime("%-m/%d/%Y")
     )
 
-def get_first_purchase_date(spending) -> datetime.datetime:
-    """Returns the first date of purchase"""
-
-    # Using the second to last result is important, as 
-    # the last result is the deposit date, which is
-    # not a purchase date
-    return spending[-2].dt
-
 def get_meal_plan_name(plan_id):
     """Gets the name for a plan based on it's ID"""
     meal_plans = {
@@ -75,6 +67,11 @@ def get_session():
     """Get the session object"""
     return session
 
+def get_request_context():
+    """Get the RequestContext loaded for this request,
+    None if the user isn't logged in or doesn't exist"""
+    return g.get('context')
+
 def log_to_console(message):
     """Simple function to send message to the console
     in a consistent manner."""
@@ -83,101 +80,10 @@ def log_to_console(message):
     else:
         print(f"GET {request.remote_addr} @ {request.url} -> {message}")
 
-def get_daily_spending(purchases):
-    """Process CSV output from TigerSpend into array of total costs per day"""
-    daily_spent = {}
-
-    for purchase in purchases:
-        # keys in the dictionary are the date on which transactions occurred
-        key = purchase.dt.strftime("%-m/%d/%Y")
-        try:
-            if not key in daily_spent:
-                daily_spent[key] = 0
-            daily_spent[key] += round(purchase.amount, 2)
-        except ValueError:
-            continue
-        except IndexError:
-            continue
-    return daily_spent
-
-
-def get_spending_over_time(purchases, days=7, backwards_offset=0):
-    """Return cost over a certain pay period."""
-    daily_spent = get_daily_spending(purchases)
-
-    money_spent = 0
-    today = datetime.datetime.today()
-    for daydelta in range(backwards_offset, days + backwards_offset):
-        # get the date of the start of the range
-        target = datetime.timedelta(days=daydelta)
-        target_date = datetime.datetime.strftime(today - target, "%-m/%d/%Y")
-
-        # add on the spending per day
-        try:
-            money_spent += daily_spent[target_date]
-        except KeyError:
-            # continues if there is no date provided in the dictionary
-            # (no payments that date)
-            continue
-    return round(money_spent, 2)
-
-def process_location(raw_location):
-    """Takes the location code from the CSV and converts it to a
-    more readable format."""
-    locations = {
-        "WELLNESS": "Vending Machine (Wellness)",
-        "BEVERAGE": "Vending Machine (Beverage)",
-        "SNACK": "Vending Machine (Snack)",
-        "STARBUCKS": "Vending Machine (StarBucks)",
-        "FOOD": "Vending Machine (FOOD)",
-        "MILK": "Vending Machine (Milk)",
-        "Beanz": "Beanz",
-        "Commons": "The Commons",
-        "Gracie": "Gracie's",
-        "Corner": "The Corner Store",
-        "Ctrl Alt DELi": "Ctrl Alt DELi",
-        "Crossroads": "C&M at The Crossroads",
-        "RITz": "RITz Sports Zone",
-        "Market": "Global Village Market",
-        "Underground": "Sol's Underground",
-        "Tablet": "Food Trucks",
-        "Midnight": "Midnight Oil",
-        "Grind": "The College Grind",
-        "Concessions": "Campus Concessions",
-        "Cantina": "GV Cantina & Grille",
-        "Artesano": "Artesano Bakery & Cafe",
-        "Brick City": "Brick City Cafe",
-        "Nathan": "Nathan's Soup & Salad",
-        "Jerry": "Ben & Jerry's",
-        "Petals": "RIT Inn Petals",
-        "Deposit": "Deposit",
-        "Moves": "Transfer to Rollover"
-    }
-
-    for item in locations.items():
-        if item[0] in raw_location:
-            if "OnDemand" in raw_location:
-                return item[1] + " (Online)"
-            return item[1]
-    print(f"got nothing for: {raw_location}")
-    return "Unknown"
-
-def get_spending_per_day(spending, days):
-    """Uses the spending to generate a dictionary of spending per day"""
-    a_sum = 0
-    count = 0
-    spending_a = { (datetime.datetime.today() - datetime.timedelta(days=i)).date(): [] for i in range(days)}
-    for purchase in list(spending):
-        purchase.location = process_location(purchase.location)
-        purchase.amount *= -1
-        a_sum += purchase.amount
-        count += 1
-        if purchase.dt.date() not in spending_a:
-            spending_a[purchase.dt.date()] = []
-        spending_list = spending_a[purchase.dt.date()]
-        spending_list.append(purchase)
-    return spending_a, a_sum, count
-
 def get_transaction_as_text(transaction: database.Purchases):
     """Returns a transaction as a string"""
-    return f"({get_meal_plan_name(transaction.plan_id)}) A purchase of ${transaction.amount} was made at {process_location(transaction.location)} at {transaction.dt.strftime('%-I:%M%p')}! Your balance is now ${transaction.new_balance}."
+    return f"({get_meal_plan_name(transaction.plan_id)}) A purchase of ${transaction.amount} was made at {transaction.display_location} at {transaction.dt.strftime('%-I:%M%p')}! Your balance is now ${transaction.new_balance}."
+
+def get_balance_alert_as_text(transaction: database.Purchases, threshold: float):
+    """Returns a low balance alert for the purchase that took the balance below threshold"""
+    return f"({get_meal_plan_name(transaction.plan_id)}) Your balance is down to ${transaction.new_balance}, below your alert of ${threshold:.2f}."
@@ -0,0 +1,263 @@
+"""
+Performance metrics, exposed in the Prometheus text format.
+
+Flask hooks time every request along with the number of database queries
+it ran and the time they took, SQLAlchemy events time every query, and the
+TigerSpend client and the sync time each upstream request and sync task.
+The web app serves the metrics at /metrics to scrapers presenting
+METRICS_TOKEN as a bearer token, and not at all without one; the sync worker
+serves them on its own port. Every process keeps its own numbers, so each one
+is scraped on its own.
+
+Requests slower than SLOW_REQUEST_SECONDS are also logged, one JSON line each.
+"""
+
+import bisect
+import hmac
+import json
+import os
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+from sqlalchemy import event
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    """A named metric with one value per combination of label values"""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {} # label values -> value
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+    def samples(self):
+        """Yields (name, labels, value) for every sample of the metric"""
+        return iter(())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {value:g}' for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A count that only goes up"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Gauge(Metric):
+    """A value read from function when the metrics are collected.
+    function returns a single value, or {label value: value} for a metric with one label."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function, labels=()):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def samples(self):
+        values = self.function()
+        if not isinstance(values, dict):
+            yield self.name, '', values
+            return
+        for label, value in values.items():
+            yield self.name, self._labels((label,)), value
+
+
+class Histogram(Metric):
+    """Observations counted into buckets of upper bounds, along with their sum"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0]) # bucket counts, sum, count
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the time taken by the block. Labels can still be
+        changed on the yielded dict, e.g. to record the block's outcome."""
+        start = perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield self.name + '_bucket', self._labels(key, [('le', f'{bound:g}')]), cumulative
+            yield self.name + '_bucket', self._labels(key, [('le', '+Inf')]), count
+            yield self.name + '_sum', self._labels(key), total
+            yield self.name + '_count', self._labels(key), count
+
+
+def render():
+    """Every registered metric in the Prometheus text format"""
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+request_seconds = Histogram('tigerwallet_request_seconds',
+    "Time taken to answer a request", ['endpoint', 'method', 'status'])
+request_queries = Histogram('tigerwallet_request_queries',
+    "Database queries run per request", ['endpoint'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55))
+request_db_seconds = Histogram('tigerwallet_request_db_seconds',
+    "Time per request spent waiting on database queries", ['endpoint'])
+slow_requests = Counter('tigerwallet_slow_requests_total',
+    "Requests that took longer than SLOW_REQUEST_SECONDS", ['endpoint'])
+query_seconds = Histogram('tigerwallet_db_query_seconds',
+    "Time taken by each database query", ['statement'])
+upstream_seconds = Histogram('tigerwallet_upstream_seconds',
+    "Time taken by TigerSpend requests until their response headers arrived, retries included", ['path', 'outcome'])
+upstream_retries = Counter('tigerwallet_upstream_retries_total',
+    "TigerSpend requests that were retried", ['path'])
+sync_task_seconds = Histogram('tigerwallet_sync_task_seconds',
+    "Time taken to update or import one user's plans", ['task', 'outcome'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+
+# queries of the request being handled on this thread
+_request = threading.local()
+
+def start_request():
+    """Starts counting the queries run on this thread"""
+    _request.queries = 0
+    _request.db_seconds = 0.0
+
+def finish_request():
+    """Stops counting, returns the number of queries run on this thread and their time"""
+    queries, db_seconds = getattr(_request, 'queries', 0), getattr(_request, 'db_seconds', 0.0)
+    _request.queries = None
+    return queries, db_seconds
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['query_start'].pop()
+    query_seconds.observe(elapsed, statement=statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'EMPTY')
+    if getattr(_request, 'queries', None) is not None:
+        _request.queries += 1
+        _request.db_seconds += elapsed
+
+def instrument_database(engine, get_pool_stats):
+    """Times every query run through engine and exposes the connection pool's stats"""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    Gauge('tigerwallet_db_pool', "State of the database connection pool", get_pool_stats, ['stat'])
+
+
+def instrument_app(app, slow_seconds=None):
+    """Times every request of a Flask app, logs the slow ones and serves /metrics
+    if METRICS_TOKEN is set, since the app is public. Has to be called before any
+    other before_request hook is registered, so requests answered early by those
+    are timed too."""
+    from flask import Response, g, request, session
+
+    if slow_seconds is None:
+        slow_seconds = float(os.getenv('SLOW_REQUEST_SECONDS', '1'))
+    token = os.getenv('METRICS_TOKEN')
+
+    @app.before_request
+    def start_timer():
+        g.request_start = perf_counter()
+        start_request()
+
+    @app.after_request
+    def record_request(response):
+        if 'request_start' not in g:
+            return response
+        seconds = perf_counter() - g.request_start
+        queries, db_seconds = finish_request()
+        endpoint = request.endpoint or 'unmatched'
+        request_seconds.observe(seconds, endpoint=endpoint, method=request.method, status=response.status_code)
+        request_queries.observe(queries, endpoint=endpoint)
+        request_db_seconds.observe(db_seconds, endpoint=endpoint)
+        if seconds >= slow_seconds:
+            slow_requests.inc(endpoint=endpoint)
+            print(json.dumps({
+                'event': 'slow_request',
+                'method': request.method,
+                'path': request.path,
+                'endpoint': endpoint,
+                'status': response.status_code,
+                'seconds': round(seconds, 3),
+                'queries': queries,
+                'db_seconds': round(db_seconds, 3),
+                'user': session.get('id'),
+            }))
+        return response
+
+    if not token:
+        print("METRICS_TOKEN is not set, not serving /metrics")
+        return
+
+    def serve_metrics():
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+            return Response("Unauthorized\n", 401, content_type='text/plain')
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', serve_metrics)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port, host='0.0.0.0'):
+    """Serves the metrics of a process without a web app, like the sync worker, on a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    return server
@@ -0,0 +1,84 @@
+"""
+Applies the versioned SQL migrations in database/migrations to the database.
+
+Usage:
+    python migrate.py            apply every pending migration
+    python migrate.py --to 2     apply pending migrations up to version 2
+    python migrate.py --status   list migrations and whether they are applied
+"""
+
+import argparse
+import datetime
+import os
+import re
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, select, text
+
+from database import engine
+
+migrations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'migrations')
+
+metadata = MetaData()
+schema_version = Table(
+    'SchemaVersion', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(64)),
+    Column('applied_at', DateTime)
+)
+
+def get_migrations():
+    """Returns (version, name, path) for every migration file, in order"""
+    migrations = []
+    for filename in os.listdir(migrations_dir):
+        match = re.match(r'^(\d+)_(\w+)\.sql$', filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(migrations_dir, filename)))
+    return sorted(migrations)
+
+def get_statements(path):
+    """Splits a migration file into its statements, dropping comments"""
+    with open(path, encoding='utf-8') as file:
+        lines = [line for line in file.read().splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+def get_applied_versions(target_engine=engine):
+    """Returns the set of versions already applied"""
+    metadata.create_all(target_engine)
+    with target_engine.connect() as connection:
+        return {row.version for row in connection.execute(select(schema_version.c.version))}
+
+def apply_migrations(target_engine=engine, target=None):
+    """Applies every pending migration up to and including target.
+    Returns the versions that were applied."""
+    applied = get_applied_versions(target_engine)
+    newly_applied = []
+    for version, name, path in get_migrations():
+        if version in applied or (target is not None and version > target):
+            continue
+        # MySQL commits DDL implicitly, so each migration is recorded right after it runs
+        with target_engine.begin() as connection:
+            for statement in get_statements(path):
+                connection.execute(text(statement))
+            connection.execute(schema_version.insert().values(
+                version=version, name=name, applied_at=datetime.datetime.now()))
+        print(f"Applied migration {version:04d}_{name}")
+        newly_applied.append(version)
+    return newly_applied
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply TigerWallet database migrations")
+    parser.add_argument('--to', type=int, default=None, help="highest version to apply")
+    parser.add_argument('--status', action='store_true', help="only list migrations")
+    args = parser.parse_args()
+
+    if args.status:
+        applied = get_applied_versions()
+        for version, name, _ in get_migrations():
+            print(f"{version:04d}_{name}: {'applied' if version in applied else 'pending'}")
+        return
+
+    if not apply_migrations(target=args.to):
+        print("Database is up to date")
+
+if __name__ == '__main__':
+    main()
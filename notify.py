@@ -0,0 +1,213 @@
+"""
+Notification dispatch.
+
+Notifications are queued in process and sent by dedicated sender threads,
+so a slow provider never holds up the sync. Notifications for the same
+recipient on the same channel that arrive within NOTIFY_COALESCE_SECONDS
+of the first one are sent as a single message, as long as it stays within
+the channel's length limit. Every channel is rate
+limited to its provider's limit, and failed sends are retried with
+exponential backoff.
+"""
+
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+from conn import send_twilio_message, post_to_pings, send_email
+
+
+class RateLimiter:
+    """Token bucket allowing rate sends per second, in bursts of up to burst sends."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the next send is allowed"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the token is taken straight away, callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Channel:
+    """A way of reaching users. send(recipient, subject, body) raises if the provider failed.
+    Messages are kept to max_length characters, None for no limit."""
+
+    def __init__(self, send, rate, burst=1, max_length=None):
+        self.send = send
+        self.limiter = RateLimiter(rate, burst)
+        self.max_length = max_length
+
+    def fit(self, body):
+        """Returns body cut down to max_length"""
+        if self.max_length is None or len(body) <= self.max_length:
+            return body
+        return body[:self.max_length - 3] + "..."
+
+
+class Batch:
+    """Notifications waiting to be sent to one recipient as a single message"""
+
+    separator = "\n\n"
+
+    def __init__(self, channel, recipient, subject, body):
+        self.channel = channel
+        self.recipient = recipient
+        self.subject = subject
+        self.bodies = [body]
+        self.length = len(body)
+        self.attempts = 0
+
+    def fits(self, body, max_length):
+        """Whether body can be added without the message growing past max_length"""
+        return max_length is None or self.length + len(self.separator) + len(body) <= max_length
+
+    def add(self, body):
+        self.bodies.append(body)
+        self.length += len(self.separator) + len(body)
+
+    def text(self):
+        return self.separator.join(self.bodies)
+
+    def __repr__(self):
+        return f'Batch(channel={self.channel}, recipient={self.recipient}, notifications={len(self.bodies)}, attempts={self.attempts})'
+
+
+class Notifier:
+    """Queue of outgoing notifications, worked off by a pool of sender threads."""
+
+    def __init__(self, channels, threads=2, coalesce_seconds=10, retries=4, backoff=2.0):
+        self.channels = channels
+        self.num_threads = threads
+        self.coalesce_seconds = coalesce_seconds
+        self.retries = retries
+        self.backoff = backoff
+        self.condition = threading.Condition()
+        self.queue = [] # heap of (due, seq, batch)
+        self.pending = {} # (channel, recipient) -> batch still open for coalescing
+        self.sequence = itertools.count()
+        self.threads = []
+        self.stopping = False
+        self.sent = 0
+        self.failed = 0
+
+    def notify(self, channel, recipient, body, subject="TigerWallet"):
+        """Queues a notification, it is sent once the coalescing window has passed"""
+        if channel not in self.channels:
+            raise ValueError(f"Unknown notification channel {channel}")
+        body = self.channels[channel].fit(body)
+        with self.condition:
+            if not self.threads:
+                self.start()
+            batch = self.pending.get((channel, recipient))
+            if batch is not None and batch.fits(body, self.channels[channel].max_length):
+                batch.add(body)
+                return
+            # a full batch stays queued as it is, later notifications go to a new one
+            batch = Batch(channel, recipient, subject, body)
+            self.pending[(channel, recipient)] = batch
+            self._schedule(batch, time.monotonic() + self.coalesce_seconds)
+
+    def start(self):
+        """Starts the sender threads"""
+        with self.condition:
+            self.stopping = False
+            for i in range(self.num_threads - len(self.threads)):
+                thread = threading.Thread(target=self._work, name=f'Notifier-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self, timeout=30):
+        """Sends everything still queued without waiting for coalescing or retries,
+        then stops the sender threads"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+
+    def _schedule(self, batch, due):
+        heapq.heappush(self.queue, (due, next(self.sequence), batch))
+        self.condition.notify()
+
+    def _next(self):
+        """Waits for the next batch that is due, returns None once stopped with nothing left"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.queue and (self.stopping or self.queue[0][0] <= now):
+                    _, _, batch = heapq.heappop(self.queue)
+                    key = (batch.channel, batch.recipient)
+                    if self.pending.get(key) is batch:
+                        del self.pending[key]
+                    return batch
+                if self.stopping:
+                    return None
+                self.condition.wait(self.queue[0][0] - now if self.queue else None)
+
+    def _work(self):
+        while (batch := self._next()) is not None:
+            self._send(batch)
+
+    def _send(self, batch):
+        channel = self.channels[batch.channel]
+        channel.limiter.acquire()
+        try:
+            channel.send(batch.recipient, batch.subject, batch.text())
+            self.sent += 1
+        except Exception as e:
+            batch.attempts += 1
+            if batch.attempts > self.retries or self.stopping:
+                print (f"Giving up on {batch}! {e}")
+                self.failed += 1
+                return
+            # full jitter keeps retries from hitting the provider in lockstep
+            delay = random.uniform(0, self.backoff * 2 ** batch.attempts)
+            print (f"Failed to send {batch}, retrying in {delay:.1f}s! {e}")
+            with self.condition:
+                self._schedule(batch, time.monotonic() + delay)
+
+
+def _send_sms(phone_number, subject, body):
+    send_twilio_message(phone_number, body)
+
+def _send_ping(username, subject, body):
+    status = post_to_pings(os.getenv("PURCHASE_UUID"), username, body)
+    if status == "" or status >= 400:
+        raise RuntimeError(f"pings answered {status or 'nothing'}")
+
+def _send_email(email_address, subject, body):
+    send_email(email_address, subject, body)
+
+def default_channels():
+    """The channels TigerWallet sends through, limited to each provider's rate"""
+    return {
+        # Twilio refuses messages longer than 1600 characters
+        'sms': Channel(_send_sms, float(os.getenv('TWILIO_RATE', '1')), max_length=1600),
+        'pings': Channel(_send_ping, float(os.getenv('PINGS_RATE', '5')), burst=5),
+        'email': Channel(_send_email, float(os.getenv('EMAIL_RATE', '2')), burst=5),
+    }
+
+notifier = Notifier(
+    default_channels(),
+    threads=int(os.getenv('NOTIFY_THREADS', '2')),
+    coalesce_seconds=float(os.getenv('NOTIFY_COALESCE_SECONDS', '10')),
+    retries=int(os.getenv('NOTIFY_RETRIES', '4')),
+    backoff=float(os.getenv('NOTIFY_BACKOFF', '2'))
+)
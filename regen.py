@@ -1,70 +1,237 @@
+import heapq
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from conn import get_formatted_spending, verify_skey_integrity, send_twilio_message
-from lib import get_transaction_as_text
+from conn import get_statement_spending, StatementStatus
+from lib import get_transaction_as_text, get_balance_alert_as_text
 import database
+from metrics import sync_task_seconds
+from notify import notifier
 
-from threading import Thread
+def sync_plan(sess_data: database.SessionData, plan_id: int, state: database.SyncState):
+    """Bring a plan up to date, only requesting the days after its last synced purchase,
+    state being the plan's SyncState (None if it was never synced, without a watermark
+    while the plan was found empty or failed to import).
+    Returns the StatementStatus of the request along with the purchases
+    that were not stored before, newest first.
+    The initial import of a plan reports nothing as new."""
 
-def update_based_on_skey(entry: str, results, index: int):
-    """Update the value based on an skey
-    Made for extend_skey()"""
+    if state is None or not state.imported:
+        status, new_data = get_statement_spending(sess_data, plan_id)
+        if status is StatementStatus.OK:
+            store_full_history(sess_data.uid, plan_id, new_data)
+        return status, []
+
+    status, new_data = get_statement_spending(sess_data, plan_id, since=state.last_dt)
+    new_data = list(new_data)
+    if not new_data:
+        return status, []
+
+    # TigerSpend's times only go down to the minute, so the purchases not stored yet are
+    # found by pid rather than by time: one can share the watermark's minute
+    fresh = database.get_unstored_purchases(new_data)
+    if not fresh:
+        return status, []
+
+    # the oldest of them has to continue from the synced balance, otherwise TigerSpend's
+    # history changed and the plan is imported again. Statements list purchases newest
+    # first, so of several in the same minute the last one listed is the oldest.
+    oldest = min(reversed(fresh), key=lambda item: item.dt)
+    if round(state.last_balance - oldest.amount, 2) != round(oldest.new_balance, 2):
+        print (f"Balance mismatch for {sess_data.uid} | {plan_id}, running a full sync")
+        status, full_data = get_statement_spending(sess_data, plan_id)
+        if status is StatementStatus.OK:
+            store_full_history(sess_data.uid, plan_id, full_data)
+        fresh.sort(key=lambda item: item.dt, reverse=True)
+        return status, fresh
+
+    return status, database.sync_purchases(sess_data.uid, plan_id, new_data)
+
+def store_full_history(uid: str, plan_id: int, purchases):
+    """Streams a plan's whole history into the database, unless the statement is empty"""
+    count = database.safely_add_purchases(uid, plan_id, purchases)
+    if count:
+        print (f"Imported {count} purchases for {uid}")
+
+def notification_targets(user_settings: database.UserSettings):
+    """The (channel, recipient) pairs a user has notifications sent to"""
+    targets = []
+    if user_settings.phone_number:
+        targets.append(('sms', user_settings.phone_number.replace("-", "").replace("(", "").replace(")", "").replace(" ", "")))
+    if user_settings.email_address:
+        targets.append(('email', user_settings.email_address))
+    return targets
+
+def balance_alert(previous_balance, new_items, threshold):
+    """Returns the new purchase that took the balance below threshold, None if the
+    balance did not cross it. new_items are newest first."""
+    if previous_balance is None or not new_items:
+        return None
+    if previous_balance >= threshold > new_items[0].new_balance:
+        return new_items[0]
+    return None
+
+def notify_changes(user_settings: database.UserSettings, previous_balance, new_items):
+    """Queues a receipt for every new purchase, oldest first, and a balance alert
+    if the purchases took the balance below the user's threshold.
+    previous_balance is the balance stored before this sync, None for a plan never synced."""
+    targets = notification_targets(user_settings)
+    if not targets or not new_items:
+        return
+    messages = []
+    if user_settings.receipt_notifications:
+        messages += [("New purchase", get_transaction_as_text(item)) for item in reversed(new_items)]
+    if user_settings.balance_notifications:
+        threshold = user_settings.get_balance_threshold()
+        crossing = balance_alert(previous_balance, new_items, threshold)
+        if crossing is not None:
+            messages.append(("Low balance", get_balance_alert_as_text(crossing, threshold)))
+    for subject, text in messages:
+        for channel, recipient in targets:
+            notifier.notify(channel, recipient, text, subject)
+
+def update_candidate(candidate: database.SyncCandidate):
+    """Update every plan of a user loaded by database.get_sync_candidates.
+    Made for SyncScheduler"""
 
     start = time.perf_counter()
-    user = database.get_user_with_skey(entry)
-    if user is None:
-        return False
-    user_settings = database.get_user_settings(user.uid)
-    assert user_settings is not None
-    if user_settings is not None:
-        if not user_settings.credential_sync:
-            return False
-    if not verify_skey_integrity(entry):
-        database.remove_user(user.uid)
-        print (f"Failed to update {user.uid}!")
-    else:
-        for plan in database.get_meal_plans(user.uid):
+    sess_data, user_settings = candidate.session_data, candidate.settings
+    with sync_task_seconds.time(task='update', outcome='ok') as labels:
+        for plan_id, state in candidate.plans:
             try:
-                new_data = get_formatted_spending(database.get_session_data(user.uid), plan.plan_id)
-                if user_settings.receipt_notifications and new_data is not None:
-                    old_data = database.get_purchases(user.uid, plan.plan_id)
-                    print (f"{user.uid} | {plan.plan_id} had {len(new_data) - len(old_data)} new items, ({new_data[0].dt.strftime('%I:%M%p')})")
-                    if old_data is None:
-                        old_data = []
-                    if len(new_data) > len(old_data):
-                        print ("Sending receipt notifications!")
-                        send_twilio_message(
-                            user_settings.phone_number.replace("-", "").replace("(", "").replace(")", "").replace(" ", ""),
-                            get_transaction_as_text(new_data[0])
-                        )
-                database.safely_add_purchases(user.uid, new_data)
+                status, new_items = sync_plan(sess_data, plan_id, state)
+                if status is StatementStatus.EXPIRED:
+                    # the user may have signed in with a new skey while the statement was requested
+                    current = database.get_session_data(sess_data.uid)
+                    if current is not None and current.skey == sess_data.skey:
+                        database.remove_user(sess_data.uid)
+                    print (f"Failed to update {sess_data.uid}!")
+                    labels['outcome'] = 'expired'
+                    return False
+                if status is StatementStatus.UPSTREAM_ERROR:
+                    labels['outcome'] = 'upstream_error'
+                if new_items:
+                    print (f"{sess_data.uid} | {plan_id} had {len(new_items)} new items, ({new_items[0].dt.strftime('%I:%M%p')})")
+                    # state was read when this update started, so it holds the balance before this sync
+                    notify_changes(user_settings, state.last_balance if state is not None else None, new_items)
             except Exception as e:
-                print (f"Error updating {user.uid} for plan {plan.plan_id}! {e}")
-        print (f"Updated {user.uid}!")
-        results[index] += 1
-        print (f"Time taken: {time.perf_counter() - start}")
-        return True
-    return False
-
-def extend_skey(minutes, num_threads=8):
-    """Extends all skey's in the database"""
-    while True:
-        skeys = [entry.skey for entry in database.get_all_sessions() if database.get_user_settings(entry.uid).credential_sync]
-        starting_length = len(skeys)
-        threads = [Thread() for _ in range(num_threads)]
-        results = [0 for _ in range(num_threads)]
-        while True:
-            if len(skeys) > 0:
-                for i in range(len(threads)):
-                    if not threads[i].is_alive():
-                        try:
-                            threads[i] = Thread(target=update_based_on_skey, args=(skeys.pop(-1), results, i), name='SkeyUpdate')
-                            threads[i].start()
-                        except IndexError:
-                            break
-            if not any([thread.is_alive() for thread in threads]):
-                break
-            time.sleep(.35)
-        print(f"Finished Main Thread! {sum(results)} out of {starting_length} updated!")
-        print(f"Results per thread: {results}")
-        time.sleep(minutes * 60)
+                print (f"Error updating {sess_data.uid} for plan {plan_id}! {e}")
+                labels['outcome'] = 'error'
+    print (f"Updated {sess_data.uid} in {time.perf_counter() - start:.2f}s!")
+    return True
+
+class SyncScheduler:
+    """Keeps every synced user on a bounded pool of workers.
+    Users wait in a heap ordered by the time their next update is due,
+    and only get handed to the pool while a worker is free."""
+
+    def __init__(self, minutes, num_threads=8, task_timeout=120, jitter=0.1, refresh_retry=30):
+        self.interval = minutes * 60
+        self.refresh_retry = refresh_retry
+        self.num_threads = num_threads
+        self.task_timeout = task_timeout
+        self.jitter = jitter
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='SkeyUpdate')
+        self.queue = [] # heap of (due, uid)
+        self.uids = set() # every user being synced
+        self.running = {} # future -> (uid, started)
+        self.timed_out = set()
+        self.next_refresh = 0
+        self.updated = 0
+        self.failed = 0
+
+    def next_due(self, now):
+        """Each user gets their own jittered interval so updates don't bunch up"""
+        return now + self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def refresh(self, now):
+        """Picks up new users and forgets the ones that stopped syncing"""
+        uids = set(database.get_sync_uids())
+        if self.next_refresh:
+            print(f"Finished cycle! {self.updated} updated, {self.failed} failed, {len(self.timed_out)} running late")
+            print(f"Database pool: {database.get_pool_stats()}")
+        self.updated = self.failed = 0
+
+        scheduled = {uid for _, uid in self.queue} | {uid for uid, _ in self.running.values()}
+        for uid in uids - scheduled:
+            heapq.heappush(self.queue, (now + random.uniform(0, self.interval * self.jitter), uid))
+        self.uids = uids
+        self.next_refresh = now + self.interval
+
+    def reap(self, now):
+        """Reschedules finished users and reports the ones past their timeout"""
+        for future, (uid, started) in list(self.running.items()):
+            if future.done():
+                del self.running[future]
+                self.timed_out.discard(uid)
+                try:
+                    success = future.result()
+                except Exception as e:
+                    print (f"Error updating {uid}! {e}")
+                    success = False
+                if success:
+                    self.updated += 1
+                else:
+                    self.failed += 1
+                if uid in self.uids:
+                    heapq.heappush(self.queue, (self.next_due(now), uid))
+            elif now - started > self.task_timeout and uid not in self.timed_out:
+                # the worker stays busy until it returns, the rest of the pool keeps going
+                print (f"Update for {uid} has been running for over {self.task_timeout}s")
+                self.timed_out.add(uid)
+
+    def dispatch(self, now):
+        """Hands due users to the pool, as long as there is a free worker.
+        Their sync states, settings and skeys are loaded together right before,
+        so every update starts from what is stored at that point."""
+        due = []
+        while self.queue and self.queue[0][0] <= now and len(self.running) + len(due) < self.num_threads:
+            _, uid = heapq.heappop(self.queue)
+            if uid in self.uids:
+                due.append(uid)
+        if not due:
+            return
+        try:
+            candidates = database.get_sync_candidates(due)
+        except Exception as e:
+            print (f"Error loading sync candidates! {e}")
+            for uid in due:
+                heapq.heappush(self.queue, (now + self.refresh_retry, uid))
+            return
+        for uid in due:
+            candidate = candidates.get(uid)
+            if candidate is None:
+                # removed, or turned credential sync off, since the users were loaded
+                self.uids.discard(uid)
+                continue
+            future = self.executor.submit(update_candidate, candidate)
+            self.running[future] = (uid, now)
+
+    def run(self, active=None, check_every=30):
+        """Runs the scheduler until active() returns False, or forever without it.
+        active is checked at least every check_every seconds."""
+        while active is None or active():
+            now = time.monotonic()
+            self.reap(now)
+            if now >= self.next_refresh:
+                try:
+                    self.refresh(now)
+                except Exception as e:
+                    # the users already scheduled keep syncing, loading them is tried again shortly
+                    print (f"Error loading sync users! {e}")
+                    self.next_refresh = now + self.refresh_retry
+            self.dispatch(now)
+
+            wakeup = self.next_refresh if active is None else min(self.next_refresh, now + check_every)
+            if self.queue and len(self.running) < self.num_threads:
+                wakeup = min(wakeup, self.queue[0][0])
+            for uid, started in self.running.values():
+                # also wake up to report tasks that run past their timeout
+                if uid not in self.timed_out:
+                    wakeup = min(wakeup, started + self.task_timeout)
+            timeout = max(wakeup - time.monotonic(), 0.05)
+            if self.running:
+                wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout)
@@ -0,0 +1,19 @@
+import os
+import sys
+
+# the app's modules read their configuration when they are imported
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('CURRENT_SEMESTER', '2225')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def db():
+    """Empty tables in the in-memory SQLite database"""
+    import database
+    database.Base.metadata.drop_all(database.engine)
+    database.Base.metadata.create_all(database.engine)
+    yield database
+    database.Base.metadata.drop_all(database.engine)
@@ -0,0 +1,27 @@
+import json
+import os
+
+import pytest
+
+from conn import parse_account_page
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as file:
+        return file.read()
+
+@pytest.fixture
+def expected():
+    return json.loads(load_fixture('statementnew.json'))
+
+@pytest.mark.parametrize('chunk_size', [16384, 1024, 7])
+def test_account_page(expected, chunk_size):
+    page = parse_account_page(load_fixture('statementnew.html'), chunk_size)
+    assert page.account_info == expected['account_info']
+    assert [list(plan) for plan in page.plans] == expected['plans']
+
+def test_login_page_has_no_account():
+    page = parse_account_page(b'<html><body><form action="login.php"><input type="password"></form></body></html>')
+    assert page.account_info is None
+    assert page.plans == []
@@ -0,0 +1,22 @@
+import datetime
+from types import SimpleNamespace
+
+from analytics import DailyAnalytics
+
+START = datetime.datetime(2025, 8, 25)
+END = datetime.datetime(2025, 12, 18)
+
+def purchase(dt, amount):
+    return SimpleNamespace(dt=dt, amount=amount)
+
+def test_recommended_balance_counts_from_the_first_purchase():
+    analytics = DailyAnalytics([], 1000.0, first_purchases=[
+        purchase(START, -1150.0), purchase(START + datetime.timedelta(days=1), 10.0)])
+    first = START + datetime.timedelta(days=1)
+    recommended = analytics.get_recommended_balance(END, first + datetime.timedelta(days=57))
+    assert recommended == 1150.0 / (END - first).days * 57
+
+def test_recommended_balance_of_a_plan_holding_only_its_deposit():
+    analytics = DailyAnalytics([], 1150.0, first_purchases=[purchase(START, -1150.0)])
+    assert analytics.get_deposit() == 1150.0
+    assert analytics.get_recommended_balance(END, START + datetime.timedelta(days=10)) == 0.0
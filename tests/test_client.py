@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import client
+from client import TigerSpendClient, UpstreamError
+
+def serve(routes, test, **options):
+    """Runs test(tigerspend, hits) against a local server answering the GETs in routes,
+    hits counting the requests per path. Returns what test returned."""
+    async def main():
+        hits = {}
+
+        def counted(path, handler):
+            async def wrapper(request):
+                hits[path] = hits.get(path, 0) + 1
+                return await handler(request, hits[path])
+            return wrapper
+
+        app = web.Application()
+        for path, handler in routes.items():
+            app.router.add_get(path, counted(path, handler))
+        server = TestServer(app)
+        await server.start_server()
+        options.setdefault('timeout', 0.5)
+        options.setdefault('retries', 2)
+        options.setdefault('backoff', 0.01)
+        tigerspend = TigerSpendClient(base_url=str(server.make_url('')), **options)
+        try:
+            return await test(tigerspend, hits)
+        finally:
+            await tigerspend.close()
+            await server.close()
+    return asyncio.run(main())
+
+async def flaky(request, hit):
+    """Fails twice before answering"""
+    if hit <= 2:
+        return web.Response(status=503, text="down")
+    return web.Response(text="Date,Location,Amount,Balance\n", content_type='text/csv')
+
+async def broken(request, hit):
+    return web.Response(status=500, text="error")
+
+async def missing(request, hit):
+    return web.Response(status=404, text="missing")
+
+async def slow(request, hit):
+    await asyncio.sleep(2)
+    return web.Response(text="too late")
+
+async def stalled(request, hit):
+    """Sends its headers and the first chunk, then stops"""
+    response = web.StreamResponse()
+    await response.prepare(request)
+    await response.write(b"Date,Location,Amount,Balance\n")
+    await asyncio.sleep(2)
+    return response
+
+async def expired(request, hit):
+    raise web.HTTPFound('/login.php?cid=105')
+
+async def login(request, hit):
+    return web.Response(text="<form action='login.php'></form>", content_type='text/html')
+
+async def chunked(request, hit):
+    response = web.StreamResponse()
+    response.content_type = 'text/csv'
+    await response.prepare(request)
+    for i in range(5):
+        await response.write(f"row {i}\n".encode())
+    await response.write_eof()
+    return response
+
+def test_retries_5xx_until_success():
+    async def test(tigerspend, hits):
+        response = await tigerspend.get('/flaky')
+        return response, hits['/flaky']
+    response, hits = serve({'/flaky': flaky}, test)
+    assert response.status == 200
+    assert response.text() == "Date,Location,Amount,Balance\n"
+    assert hits == 3
+
+def test_gives_up_after_every_retry():
+    async def test(tigerspend, hits):
+        with pytest.raises(UpstreamError):
+            await tigerspend.get('/broken')
+        return hits['/broken']
+    assert serve({'/broken': broken}, test) == 3
+
+def test_does_not_retry_4xx():
+    async def test(tigerspend, hits):
+        response = await tigerspend.get('/missing')
+        return response.status, hits['/missing']
+    assert serve({'/missing': missing}, test) == (404, 1)
+
+def test_backoff_doubles_with_every_attempt(monkeypatch):
+    ceilings = []
+    def uniform(low, high):
+        ceilings.append(high)
+        return 0
+    monkeypatch.setattr(client.random, 'uniform', uniform)
+
+    async def test(tigerspend, hits):
+        with pytest.raises(UpstreamError):
+            await tigerspend.get('/broken')
+    serve({'/broken': broken}, test, retries=3, backoff=0.01)
+    assert ceilings == [0.01, 0.02, 0.04]
+
+def test_times_out_and_retries():
+    async def test(tigerspend, hits):
+        with pytest.raises(UpstreamError, match="TimeoutError"):
+            await tigerspend.get('/slow')
+        return hits['/slow']
+    assert serve({'/slow': slow}, test, timeout=0.2, retries=1) == 2
+
+def test_stream_times_out_between_chunks():
+    async def test(tigerspend, hits):
+        response = await tigerspend.stream('/stalled')
+        try:
+            assert await response.read_chunk() == b"Date,Location,Amount,Balance\n"
+            with pytest.raises(asyncio.TimeoutError):
+                await response.read_chunk()
+        finally:
+            await response.close()
+    serve({'/stalled': stalled}, test, timeout=0.2)
+
+def test_redirect_history_is_captured():
+    async def test(tigerspend, hits):
+        return await tigerspend.get('/statementdetail.php', {'acct': 54})
+    response = serve({'/statementdetail.php': expired, '/login.php': login}, test)
+    assert response.status == 200
+    assert '/login.php' in response.url
+    assert len(response.history) == 1
+    assert response.history[0].endswith('/statementdetail.php?acct=54')
+
+def test_stream_reads_the_body_and_frees_its_connection():
+    async def test(tigerspend, hits):
+        response = await tigerspend.stream('/chunked')
+        assert tigerspend.semaphore._value == tigerspend.max_concurrency - 1
+        body = b""
+        while chunk := await response.read_chunk(4):
+            body += chunk
+        await response.close()
+        assert tigerspend.semaphore._value == tigerspend.max_concurrency
+        return body, response.encoding
+    body, encoding = serve({'/chunked': chunked}, test)
+    assert body == b"".join(f"row {i}\n".encode() for i in range(5))
+    assert encoding == 'utf-8'
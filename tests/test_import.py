@@ -0,0 +1,58 @@
+import datetime
+
+import app as tigerwallet
+import importer
+from conn import StatementStatus
+
+UID = 'jdoe5678'
+
+def add_user(db, plan_ids):
+    now = datetime.datetime.now()
+    with db.use_session() as session:
+        session.add(db.UserInfo(uid=UID, first_name='Jane', last_name='Doe', pref_name='Jane',
+            first_sign_in=now, last_sign_in=now, total_auths=1))
+        session.flush()
+        session.add(db.UserSettings(uid=UID, credential_sync=True, receipt_notifications=False,
+            balance_notifications=False, email_address='', phone_number=''))
+        session.add(db.SessionData(uid=UID, theme='dark', skey='0' * 32, default_plan=plan_ids[0]))
+        session.add_all(db.MealPlans(uid=UID, plan_id=plan_id, plan_name=str(plan_id),
+            pid=db.meal_plan_pid(UID, plan_id)) for plan_id in plan_ids)
+    return db.get_session_data(UID)
+
+def import_plans(monkeypatch, session_data, statuses):
+    """Runs the imports of the plans in statuses, {plan_id: StatementStatus}, each statement empty.
+    Then forgets them, as a process that didn't run them would not know about them."""
+    monkeypatch.setattr(importer, 'get_statement_spending',
+        lambda sess_data, plan_id: (statuses[plan_id], iter([])))
+    runner = importer.Importer(threads=1)
+    for plan_id in statuses:
+        runner._import(session_data, plan_id)
+    runner.executor.shutdown()
+
+def get_progress():
+    client = tigerwallet.app.test_client()
+    with client.session_transaction() as session:
+        session['id'] = UID
+        session['theme'] = 'dark'
+    return client, client.get('/api/import').get_json()
+
+def test_empty_and_failed_imports_finish_in_every_process(db, monkeypatch):
+    session_data = add_user(db, [54, 1])
+    import_plans(monkeypatch, session_data, {54: StatementStatus.OK, 1: StatementStatus.UPSTREAM_ERROR})
+
+    client, progress = get_progress()
+    assert {plan['plan']: plan['status'] for plan in progress['plans']} == {54: importer.EMPTY, 1: importer.FAILED}
+    assert progress['finished'] and not progress['ready']
+    # nothing to show yet, the importing page says so instead of polling forever
+    assert client.get('/').headers['Location'] == '/importing'
+
+def test_empty_statement_leaves_an_imported_plan_alone(db):
+    add_user(db, [54])
+    dt = datetime.datetime(2025, 9, 2, 12, 0)
+    deposit = db.Purchases(uid=UID, dt=dt, location="Deposit", amount=-100.0, new_balance=100.0, plan_id=54,
+        pid=db.purchase_pid(UID, 54, dt, -100.0, 100.0))
+    assert db.safely_add_purchases(UID, 54, [deposit]) == 1
+    assert db.safely_add_purchases(UID, 54, []) == 0
+    state = db.get_sync_state(UID, 54)
+    assert (state.imported, state.last_balance) == (True, 100.0)
+    assert len(db.get_purchases(UID, 54)) == 1
@@ -0,0 +1,26 @@
+from flask import Flask
+
+import metrics
+
+def make_app(monkeypatch, token):
+    if token is None:
+        monkeypatch.delenv('METRICS_TOKEN', raising=False)
+    else:
+        monkeypatch.setenv('METRICS_TOKEN', token)
+    app = Flask(__name__)
+    metrics.instrument_app(app)
+    app.add_url_rule('/', 'index', lambda: "home")
+    return app.test_client()
+
+def test_metrics_are_not_served_without_a_token(monkeypatch):
+    client = make_app(monkeypatch, None)
+    assert client.get('/').status_code == 200
+    assert client.get('/metrics').status_code == 404
+
+def test_metrics_require_the_token(monkeypatch):
+    client = make_app(monkeypatch, 'secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert 'tigerwallet_request_seconds' in response.get_data(as_text=True)
@@ -0,0 +1,91 @@
+import threading
+import time
+
+from notify import Channel, Notifier, RateLimiter
+
+class FakeSender:
+    """Records every message, failing the first failures sends"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = 0
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def __call__(self, recipient, subject, body):
+        with self.lock:
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise RuntimeError("provider down")
+            self.messages.append((recipient, subject, body))
+
+def make_notifier(sender, max_length=None, **options):
+    options.setdefault('threads', 1)
+    options.setdefault('coalesce_seconds', 0.05)
+    options.setdefault('retries', 2)
+    options.setdefault('backoff', 0.01)
+    return Notifier({'sms': Channel(sender, rate=1000, burst=100, max_length=max_length)}, **options)
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_notifications_within_the_window_are_coalesced():
+    sender = FakeSender()
+    notifier = make_notifier(sender)
+    for i in range(3):
+        notifier.notify('sms', '5551234567', f"purchase {i}")
+    notifier.notify('sms', '5557654321', "other")
+    wait_for(lambda: len(sender.messages) == 2)
+    notifier.stop()
+    assert sorted(sender.messages) == [
+        ('5551234567', "TigerWallet", "purchase 0\n\npurchase 1\n\npurchase 2"),
+        ('5557654321', "TigerWallet", "other"),
+    ]
+
+def test_coalesced_messages_are_split_at_the_length_limit():
+    sender = FakeSender()
+    notifier = make_notifier(sender, max_length=50)
+    bodies = [f"A purchase of ${i}.00 was made" for i in range(10)]
+    for body in bodies:
+        notifier.notify('sms', '5551234567', body)
+    notifier.stop()
+    texts = [body for _, _, body in sender.messages]
+    assert len(texts) > 1
+    assert all(len(text) <= 50 for text in texts)
+    assert sorted(body for text in texts for body in text.split("\n\n")) == sorted(bodies)
+
+def test_long_notifications_are_cut_to_the_length_limit():
+    sender = FakeSender()
+    notifier = make_notifier(sender, max_length=20)
+    notifier.notify('sms', '5551234567', "x" * 100)
+    notifier.stop()
+    assert sender.messages == [('5551234567', "TigerWallet", "x" * 17 + "...")]
+
+def test_failed_sends_are_retried():
+    sender = FakeSender(failures=2)
+    notifier = make_notifier(sender)
+    notifier.notify('sms', '5551234567', "purchase")
+    wait_for(lambda: sender.messages)
+    notifier.stop()
+    assert sender.calls == 3
+    assert (notifier.sent, notifier.failed) == (1, 0)
+
+def test_sends_are_given_up_after_every_retry():
+    sender = FakeSender(failures=100)
+    notifier = make_notifier(sender, retries=2)
+    notifier.notify('sms', '5551234567', "purchase")
+    wait_for(lambda: notifier.failed)
+    notifier.stop()
+    assert sender.calls == 3
+    assert notifier.sent == 0
+
+def test_rate_limiter_spaces_out_sends_after_a_burst():
+    limiter = RateLimiter(rate=50, burst=2)
+    start = time.monotonic()
+    for _ in range(7):
+        limiter.acquire()
+    # the burst goes out straight away, the 5 sends after it wait 1/50s each
+    assert time.monotonic() - start >= 0.09
@@ -0,0 +1,23 @@
+import app as tigerwallet
+
+def test_static_urls_carry_the_content_fingerprint():
+    with tigerwallet.app.test_request_context():
+        url = tigerwallet.url_for('static', filename='styles/dark.css')
+    assert url == f"/static/styles/dark.css?v={tigerwallet.static_versions['styles/dark.css']}"
+
+def test_fingerprinted_static_files_are_cached_for_good():
+    client = tigerwallet.app.test_client()
+    version = tigerwallet.static_versions['styles/dark.css']
+    response = client.get(f'/static/styles/dark.css?v={version}')
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    assert not client.get('/static/styles/dark.css?v=old').cache_control.immutable
+
+def test_unknown_static_paths_are_not_fingerprinted():
+    versions = dict(tigerwallet.static_versions)
+    client = tigerwallet.app.test_client()
+    for path in ['/static/missing.css?v=abc', '/static/../app.py?v=abc', '/static/%2e%2e/app.py?v=abc']:
+        response = client.get(path)
+        assert response.status_code != 200
+        assert not response.cache_control.immutable
+    assert tigerwallet.static_versions == versions
@@ -0,0 +1,94 @@
+import datetime
+
+from sqlalchemy import event
+
+import regen
+from conn import StatementStatus
+from database import Purchases, purchase_pid
+
+UID = 'jdoe5678'
+PLAN_ID = 54
+NOON = datetime.datetime(2025, 9, 2, 12, 0)
+
+def purchase(dt, amount, new_balance, location="Gracie Dining"):
+    return Purchases(uid=UID, dt=dt, location=location, amount=amount, new_balance=new_balance,
+        plan_id=PLAN_ID, pid=purchase_pid(UID, PLAN_ID, dt, amount, new_balance))
+
+def fake_statements(monkeypatch, statement):
+    """Answers every statement request with statement, recording the since of each one"""
+    requests = []
+    def get_statement_spending(sess_data, plan_id, since=None):
+        requests.append(since)
+        return StatementStatus.OK, iter(statement)
+    monkeypatch.setattr(regen, 'get_statement_spending', get_statement_spending)
+    return requests
+
+def test_purchase_in_the_watermark_minute_is_synced(db, monkeypatch):
+    deposit = purchase(NOON - datetime.timedelta(hours=1), -100.0, 100.0, "Deposit")
+    first = purchase(NOON, 5.0, 95.0)
+    db.safely_add_purchases(UID, PLAN_ID, [first, deposit])
+    state = db.get_sync_state(UID, PLAN_ID)
+
+    # a second $5 purchase in the same minute as the watermark, and a later one
+    same_minute = purchase(NOON, 5.0, 90.0)
+    later = purchase(NOON + datetime.timedelta(minutes=5), 3.0, 87.0)
+    requests = fake_statements(monkeypatch, [later, same_minute, first])
+    session_data = db.SessionData(uid=UID, skey='0' * 32)
+
+    status, new_items = regen.sync_plan(session_data, PLAN_ID, state)
+
+    assert status is StatementStatus.OK
+    assert requests == [state.last_dt] # no full sync
+    assert [item.pid for item in new_items] == [later.pid, same_minute.pid]
+    assert len(db.get_purchases(UID, PLAN_ID)) == 4
+    state = db.get_sync_state(UID, PLAN_ID)
+    assert (state.last_dt, state.last_balance) == (later.dt, 87.0)
+
+def test_changed_history_runs_a_full_sync(db, monkeypatch):
+    deposit = purchase(NOON - datetime.timedelta(hours=1), -100.0, 100.0, "Deposit")
+    first = purchase(NOON, 5.0, 95.0)
+    db.safely_add_purchases(UID, PLAN_ID, [first, deposit])
+    state = db.get_sync_state(UID, PLAN_ID)
+
+    # doesn't continue from the stored $95
+    later = purchase(NOON + datetime.timedelta(minutes=5), 3.0, 80.0)
+    requests = fake_statements(monkeypatch, [later, first])
+
+    status, new_items = regen.sync_plan(db.SessionData(uid=UID, skey='0' * 32), PLAN_ID, state)
+
+    assert len(requests) == 2
+    assert [item.pid for item in new_items] == [later.pid]
+
+def add_user(db, uid, credential_sync=True):
+    now = datetime.datetime.now()
+    with db.use_session() as session:
+        session.add(db.UserInfo(uid=uid, first_name='Jane', last_name='Doe', pref_name='Jane',
+            first_sign_in=now, last_sign_in=now, total_auths=1))
+        session.flush()
+        session.add(db.UserSettings(uid=uid, credential_sync=credential_sync, receipt_notifications=False,
+            balance_notifications=False, email_address='', phone_number=''))
+        session.add(db.SessionData(uid=uid, theme='dark', skey=uid.ljust(32, '0'), default_plan=PLAN_ID))
+        session.add_all(db.MealPlans(uid=uid, plan_id=plan_id, plan_name=str(plan_id),
+            pid=db.meal_plan_pid(uid, plan_id)) for plan_id in (1, PLAN_ID))
+
+def test_scheduler_loads_each_batch_of_users_in_one_query(db, monkeypatch):
+    for i in range(5):
+        add_user(db, f'user{i}')
+    add_user(db, 'nosync', credential_sync=False)
+    updated = []
+    monkeypatch.setattr(regen, 'update_candidate', lambda candidate: updated.append(candidate) or True)
+    queries = []
+    listener = lambda *args: queries.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        scheduler = regen.SyncScheduler(minutes=5, num_threads=8)
+        scheduler.refresh(0)
+        assert len(queries) == 1
+        scheduler.dispatch(scheduler.interval)
+        assert len(queries) == 2
+        scheduler.executor.shutdown(wait=True)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+    assert sorted(candidate.session_data.uid for candidate in updated) == [f'user{i}' for i in range(5)]
+    assert all([plan_id for plan_id, _ in candidate.plans] == [1, PLAN_ID] for candidate in updated)
@@ -0,0 +1,116 @@
+"""
+Standalone background sync worker.
+
+Keeps every user's purchases up to date with TigerSpend, outside of the web
+process. Any number of workers can be started, a lease in the database makes
+sure only one of them runs the scheduler at a time, the others stand by and
+take over when the active worker stops renewing it.
+
+Usage:
+    python worker.py [--minutes UPDATE_RATE] [--threads NUM_THREADS] [--lease-ttl 90] [--metrics-port METRICS_PORT]
+    python worker.py --rebuild-rollups [--uid UID]   recompute DailySpending and exit
+    python worker.py --classify-locations            classify stored purchases' locations and exit
+"""
+
+import argparse
+import os
+import socket
+import time
+
+from dotenv import load_dotenv
+
+# database reads its connection settings on import
+load_dotenv()
+
+import database
+import metrics
+from notify import notifier
+from regen import SyncScheduler
+
+LEASE_NAME = 'sync-scheduler'
+
+class Lease:
+    """Holds the scheduler lease, renewing it well before it expires"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.renew_at = 0
+        self.held = False
+
+    def check(self):
+        """Returns whether this worker still holds the lease"""
+        now = time.monotonic()
+        if now >= self.renew_at:
+            try:
+                held = database.acquire_lease(LEASE_NAME, self.holder, self.ttl)
+            except Exception as e:
+                print(f"Failed to renew the scheduler lease! {e}")
+                held = False
+            if held != self.held:
+                print(f"{self.holder} {'acquired' if held else 'lost'} the scheduler lease")
+            self.held = held
+            self.renew_at = now + self.ttl / 3
+        return self.held
+
+    def release(self):
+        """Lets a standby worker take over straight away"""
+        if self.held:
+            database.release_lease(LEASE_NAME, self.holder)
+            self.held = False
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the TigerWallet background sync")
+    parser.add_argument('--minutes', type=float, default=float(os.getenv('UPDATE_RATE', '5')),
+        help="minutes between updates of each user")
+    parser.add_argument('--threads', type=int, default=int(os.getenv('NUM_THREADS', '8')),
+        help="number of users updated at the same time")
+    parser.add_argument('--lease-ttl', type=float, default=90,
+        help="seconds before a standby worker may take over from a silent one")
+    parser.add_argument('--metrics-port', type=int, default=int(os.getenv('METRICS_PORT', '0')),
+        help="port the Prometheus metrics are served on, none if 0")
+    parser.add_argument('--rebuild-rollups', action='store_true',
+        help="recompute the DailySpending rollups from the stored purchases and exit")
+    parser.add_argument('--uid', help="only rebuild the rollups of this user")
+    parser.add_argument('--classify-locations', action='store_true',
+        help="store the classified location of purchases synced before it was, or since the table changed, and exit")
+    args = parser.parse_args()
+
+    os.environ['TZ'] = "America/New_York"
+    time.tzset()
+
+    if args.rebuild_rollups:
+        start = time.monotonic()
+        plans = database.rebuild_daily_spending(args.uid)
+        print(f"Rebuilt the daily spending of {plans} plans in {time.monotonic() - start:.1f}s")
+        return
+
+    if args.classify_locations:
+        start = time.monotonic()
+        changed = database.classify_stored_locations()
+        print(f"Classified the locations of {changed} purchases in {time.monotonic() - start:.1f}s")
+        return
+
+    metrics.instrument_database(database.engine, database.get_pool_stats)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print(f"Serving metrics on port {args.metrics_port}")
+
+    lease = Lease(args.lease_ttl)
+    scheduler = SyncScheduler(args.minutes, args.threads)
+    print(f"Starting sync worker {lease.holder}")
+    try:
+        while True:
+            if lease.check():
+                scheduler.run(active=lease.check, check_every=args.lease_ttl / 3)
+            else:
+                time.sleep(args.lease_ttl / 3)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lease.release()
+        # send the notifications still waiting in the queue
+        notifier.stop()
+
+if __name__ == '__main__':
+    main()